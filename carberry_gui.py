@@ -1,36 +1,213 @@
 #!/usr/bin/env python
 
+import os
 import wx
 import time
-from threading import Thread
+from threading import Thread, Event
+from utils.carberry_utils import CACHE_DIR
+from utils.debug_event import debug_display, EVT_DEBUG_ID
 from carberry_io.carberry_capture import CarberryObdCapture
+from carberry_io.carberry_poller import CarberryObdPoller
+from carberry_io.carberry_rate import CarberryRateController
+from carberry_io.carberry_history import CarberryHistory
+from carberry_io.carberry_derived import CarberryDerivedSensors
+from carberry_io.carberry_dtc import CarberryDtcMonitor, DTC_CHECK_INTERVAL
 
 
 # Constants
+# Longest delay (ms) between two gauge refreshes, they follow the poll rate
+# of the shown sensors when it is faster
 SENSOR_REFRESH_TIMER = 1000
+GAUGE_SLOTS = 6
+
+# A gauge is only updated when its value moved by more than the deadband of
+# the sensor (by short name, DEFAULT_DEADBAND otherwise), at most once per
+# GAUGE_MIN_INTERVAL seconds. A value older than GAUGE_MAX_STALENESS seconds
+# is always replaced. The timer ticks at GAUGE_MIN_INTERVAL at the fastest,
+# the rate limit lets through ticks up to GAUGE_RATE_SLACK seconds early.
+DEADBANDS = {
+    "rpm"              : 25,
+    "speed"            : 0.5,
+    "maf"              : 0.01,
+    "load"             : 1,
+    "throttle_pos"     : 1,
+    "manifold_pressure": 1,
+    }
+DEFAULT_DEADBAND = 0
+GAUGE_MIN_INTERVAL = 0.25
+GAUGE_RATE_SLACK = 0.05
+GAUGE_MAX_STALENESS = 5.0
 BACKGROUND = "elementary.jpg"
 SMALL_LOGO = "car.png"
+LOGO_SCALE = 17
 
+# Connection attempts, first delay between two attempts (doubled after each
+# failure) and overall time limit, in seconds
+CONNECT_ATTEMPTS = 5
+CONNECT_BACKOFF = 2
+CONNECT_TIMEOUT = 60
 
-def obd_connect(object):
-    object.connect()
+# Positions of the debug events sent by the connection thread, the port
+# itself uses 1 to 3
+CONNECTION_PROGRESS = 0
+CONNECTION_DONE = 4
+CONNECTION_FAILED = 5
+
+# Scaled images are kept here between runs
+IMAGE_CACHE_DIR = os.path.join(CACHE_DIR, "images")
+
+# (filename, size) -> wx.Bitmap, shared by all frames and panels
+BITMAP_CACHE = {}
+
+
+def obd_connect(connection):
+    connection.run()
+
+
+def get_scaled_bitmap(filename, size):
+    """
+    Bitmap of filename scaled to size, a (width, height) tuple or a divisor
+    of the image size. Each image is decoded and scaled once, and the scaled
+    result is saved for the next start.
+    """
+    key = (filename, size)
+    if key in BITMAP_CACHE:
+        return BITMAP_CACHE[key]
+
+    if isinstance(size, tuple):
+        tag = "%dx%d" % size
+    else:
+        tag = "div%d" % size
+    name, extension = os.path.splitext(os.path.basename(filename))
+
+    # BMP is uncompressed and the fastest to load, PNG keeps transparency
+    if extension.lower() == ".png":
+        extension, image_type = ".png", wx.BITMAP_TYPE_PNG
+    else:
+        extension, image_type = ".bmp", wx.BITMAP_TYPE_BMP
+    cached = os.path.join(IMAGE_CACHE_DIR, "%s-%s%s" % (name, tag, extension))
+
+    if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(filename):
+        image = wx.Image(cached, image_type)
+    else:
+        image = wx.Image(filename)
+        if isinstance(size, tuple):
+            width, height = size
+        else:
+            width, height = image.GetWidth()/size, image.GetHeight()/size
+        image = image.Scale(width, height, wx.IMAGE_QUALITY_HIGH)
+        try:
+            if not os.path.isdir(IMAGE_CACHE_DIR):
+                os.makedirs(IMAGE_CACHE_DIR)
+            image.SaveFile(cached, image_type)
+        except (IOError, OSError) as e:
+            print e
+
+    bitmap = wx.BitmapFromImage(image)
+    BITMAP_CACHE[key] = bitmap
+    return bitmap
+
+
+def get_background_bitmap():
+    return get_scaled_bitmap(BACKGROUND, tuple(wx.GetDisplaySize()))
+
+
+def paint_background(window, dc, bitmap):
+    """
+    Blit the parts of bitmap that lie in the damaged region of window.
+    """
+    source = wx.MemoryDC(bitmap)
+    regions = wx.RegionIterator(window.GetUpdateRegion())
+    while regions.HaveRects():
+        rect = regions.GetRect()
+        dc.Blit(rect.x, rect.y, rect.width, rect.height, source, rect.x, rect.y)
+        regions.Next()
 
 
 class CarberryObdConnection(object):
     """
     Class for OBD connection. Use a thread for the connection.
+
+    Progress is posted to notify_window as debug events, ending with
+    CONNECTION_DONE (message is the first capture) or CONNECTION_FAILED.
     """
     
-    def __init__(self):
-        self.capture = CarberryObdCapture()
+    def __init__(self, notify_window=None):
+        self.notify_window = notify_window
+        self.capture = CarberryObdCapture(notify_window)
+        self.poller = None
+        self.history = CarberryHistory()
+        self.derived = CarberryDerivedSensors()
+        self.dtc_monitor = CarberryDtcMonitor()
+        self.cancelled = Event()
 
     def get_capture(self):
         return self.capture
 
+    def start_polling(self, sensor_indexes):
+        """
+        Hand the port over to a background poller. The port must not be used
+        from any other thread afterwards.
+        """
+        port = self.capture.is_connected()
+        if port and self.poller is None:
+            self.poller = CarberryObdPoller(port, sensor_indexes, rate_controller=CarberryRateController())
+            self.poller.add_listener(self.history.record_values)
+            self.poller.add_listener(self.derived.record_values)
+            self.poller.add_task(self.dtc_monitor.check, DTC_CHECK_INTERVAL)
+            self.poller.start()
+        return self.poller
+
+    def get_poller(self):
+        return self.poller
+
+    def get_history(self):
+        return self.history
+
+    def get_derived(self):
+        return self.derived
+
+    def get_dtc_monitor(self):
+        return self.dtc_monitor
+
     def connect(self):
-        self.t = Thread(target=obd_connect, args=(self.capture,))
+        self.t = Thread(target=obd_connect, args=(self,))
+        self.t.daemon = True
         self.t.start()
 
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        """
+        Connection thread: try to connect, backing off between attempts.
+        """
+        deadline = time.time() + CONNECT_TIMEOUT
+        delay = CONNECT_BACKOFF
+        for attempt in range(1, CONNECT_ATTEMPTS+1):
+            if self.cancelled.is_set():
+                break
+
+            debug_display(self.notify_window, CONNECTION_PROGRESS,
+                          " Trying to connect (%d/%d) ... %s" % (attempt, CONNECT_ATTEMPTS, time.asctime()))
+            self.capture.connect()
+            if self.capture.is_connected():
+                debug_display(self.notify_window, CONNECTION_DONE, str(self.get_output()))
+                return
+
+            remaining = deadline - time.time()
+            if attempt == CONNECT_ATTEMPTS or remaining <= 0:
+                break
+            debug_display(self.notify_window, CONNECTION_PROGRESS,
+                          " No adapter found, retrying in %d s" % delay)
+            self.cancelled.wait(min(delay, remaining))
+            delay *= 2
+
+        if self.cancelled.is_set():
+            debug_display(self.notify_window, CONNECTION_FAILED, " Cancelled")
+        else:
+            debug_display(self.notify_window, CONNECTION_FAILED, " No adapter answered")
+
     def is_connected(self):
         return self.capture.is_connected()
 
@@ -93,7 +270,7 @@ class CarberryStaticBox(wx.StaticBox):
         self.Paint(wx.PaintDC(self)) 
 
     def Paint(self, dc): 
-        dc.DrawBitmap(self.bitmap, 0, 0)     
+        paint_background(self, dc, self.bitmap)
 
 
 class CarberryPanelGauges(wx.Panel):
@@ -108,10 +285,7 @@ class CarberryPanelGauges(wx.Panel):
         super(CarberryPanelGauges, self).__init__(*args, **kwargs)
 
         # Background image
-        image = wx.Image(BACKGROUND)
-        width, height = wx.GetDisplaySize() 
-        image = image.Scale(width, height, wx.IMAGE_QUALITY_HIGH)
-        self.bitmap = wx.BitmapFromImage(image) 
+        self.bitmap = get_background_bitmap()
         self.Bind(wx.EVT_PAINT, self.on_paint)
 
         # Create an accelerator table for controls
@@ -142,9 +316,23 @@ class CarberryPanelGauges(wx.Panel):
         # Port 
         self.port = None
 
-        # List to hold children widgets
+        # Background poller, owns the port once the gauges are shown
+        self.poller = None
+
+        # Gauge slots, created once by create_gauges
         self.boxes = []
-        self.texts = []
+        self.value_texts = []
+        self.name_texts = []
+
+        # Label currently shown by each slot, and the (value, time) it was
+        # set from
+        self.labels = []
+        self.shown = []
+        # last value held back by each slot, so that it is counted once
+        self.held = []
+
+        # sensor short name -> updates held back by the deadband or the rate limit
+        self.suppressed = {}
 
     def set_connection(self, connection):
         self.connection = connection
@@ -155,31 +343,42 @@ class CarberryPanelGauges(wx.Panel):
     def set_port(self, port):
         self.port = port
 
+    def set_poller(self, poller):
+        self.poller = poller
+
     def get_sensors_to_display(self, istart):
         """
         Get at most 6 sensors to be displayed on screen.
         """
         sensors_display = []
         if istart < len(self.sensors):
-            iend = istart + 6
+            iend = istart + GAUGE_SLOTS
             sensors_display = self.sensors[istart:iend]
         return sensors_display
 
-    def show_sensors(self):
+    def get_values(self, sensors):
         """
-        Display the sensors.
+        Latest (name, value, unit) of the given sensors, as read by the poller.
         """
-        
-        sensors = self.get_sensors_to_display(self.istart)
+        snapshot = {}
+        if self.poller:
+            snapshot = self.poller.get_snapshot()
 
-        # Destroy previous widgets
-        for b in self.boxes:
-            b.Destroy()
-        for t in self.texts:
-            t.Destroy()
+        values = []
+        for index, sensor in sensors:
+            if index in snapshot:
+                values.append(snapshot[index][:3])
+            else:
+                values.append((sensor.name, "-", sensor.unit))
+        return values
 
-        self.boxes = []
-        self.texts = []
+    def create_gauges(self):
+        """
+        Create the gauge slots and the refresh timer, once. Changing page
+        only relabels them.
+        """
+        value_font = wx.Font(32, wx.ROMAN, wx.NORMAL, wx.NORMAL, faceName="Monaco")
+        name_font = wx.Font(13, wx.ROMAN, wx.NORMAL, wx.BOLD, faceName="Monaco")
 
         # Main sizer
         main_box_sizer = wx.BoxSizer(wx.VERTICAL)
@@ -189,69 +388,126 @@ class CarberryPanelGauges(wx.Panel):
         grid_rows, grid_cols = 2, 3
         grid_sizer = wx.GridSizer(grid_rows, grid_cols, vertical_gap, height_gap)
 
-        # Create a box for each sensor
-        for index, sensor in sensors:
-            
-            (name, value, unit) = self.port.sensor(index)
+        # Text does not resize with its label, a new value does not relayout
+        text_style = wx.ALIGN_CENTER | wx.ST_NO_AUTORESIZE
 
+        for i in range(GAUGE_SLOTS):
             box = CarberryStaticBox(self, wx.ID_ANY)
             self.boxes.append(box)
             box_sizer = wx.StaticBoxSizer(box, wx.VERTICAL)
 
             # Text for sensor value 
-            if type(value) == float:
-                value = str("%.2f" % round(value, 3))
-
-            sensor_value_text = wx.StaticText(parent=self, label=str(value), style=wx.ALIGN_CENTER)
+            sensor_value_text = wx.StaticText(parent=self, label="", style=text_style)
             sensor_value_text.SetForegroundColour('WHITE')
-            font1 = wx.Font(32, wx.ROMAN, wx.NORMAL, wx.NORMAL, faceName="Monaco")
-            sensor_value_text.SetFont(font1)
-            box_sizer.Add(sensor_value_text, 0, wx.ALIGN_CENTER | wx.ALL, 20)
+            sensor_value_text.SetFont(value_font)
+            box_sizer.Add(sensor_value_text, 0, wx.EXPAND | wx.ALL, 20)
             box_sizer.AddStretchSpacer()
-            self.texts.append(sensor_value_text)
+            self.value_texts.append(sensor_value_text)
+            self.labels.append(None)
+            self.shown.append(None)
+            self.held.append(None)
 
             # Text for sensor name
-            sensor_name_text = wx.StaticText(parent=self, label=unit+"\n"+name, style=wx.ALIGN_CENTER)
+            sensor_name_text = wx.StaticText(parent=self, label="\n", style=text_style)
             sensor_name_text.SetForegroundColour('WHITE')
-            font2 = wx.Font(13, wx.ROMAN, wx.NORMAL, wx.BOLD, faceName="Monaco")
-            sensor_name_text.SetFont(font2)
-            box_sizer.Add(sensor_name_text, 0, wx.ALIGN_CENTER | wx.ALL, 5)
-            self.texts.append(sensor_name_text)
+            sensor_name_text.SetFont(name_font)
+            box_sizer.Add(sensor_name_text, 0, wx.EXPAND | wx.ALL, 5)
+            self.name_texts.append(sensor_name_text)
             grid_sizer.Add(box_sizer, 1, wx.EXPAND | wx.ALL)
 
-        # Add invisible boxes if necessary
-        for i in range(6-len(sensors)):
-            box = CarberryStaticBox(self)
-            box_sizer = wx.StaticBoxSizer(box, wx.VERTICAL)
-            self.boxes.append(box)
-            box.Show(False)
-            grid_sizer.Add(box_sizer, 1, wx.EXPAND | wx.ALL)
-           
         # Layout
         main_box_sizer.Add(grid_sizer, 1, wx.EXPAND | wx.ALL, 10)
         self.SetSizer(main_box_sizer)
-        self.Refresh()
-        self.Layout() 
 
         # Timer for update
         self.timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.refresh, self.timer)
         self.timer.Start(SENSOR_REFRESH_TIMER)
 
+    def set_value(self, slot, sensor, value):
+        """
+        Show value in the given slot, if it changed enough.
+        """
+        now = time.time()
+        shown = self.shown[slot]
+        numbers = (int, long, float)
+        if shown is not None and isinstance(value, numbers) and isinstance(shown[0], numbers) \
+                and now - shown[1] < GAUGE_MAX_STALENESS:
+            deadband = DEADBANDS.get(sensor.short_name, DEFAULT_DEADBAND)
+            if abs(value - shown[0]) <= deadband or now - shown[1] < GAUGE_MIN_INTERVAL - GAUGE_RATE_SLACK:
+                if value != shown[0] and value != self.held[slot]:
+                    self.suppressed[sensor.short_name] = self.suppressed.get(sensor.short_name, 0) + 1
+                    self.held[slot] = value
+                return
+        self.shown[slot] = (value, now)
+        self.held[slot] = None
+
+        if type(value) == float:
+            label = str("%.2f" % round(value, 3))
+        else:
+            label = str(value)
+
+        if label != self.labels[slot]:
+            self.value_texts[slot].SetLabel(label)
+            self.labels[slot] = label
+
+    def show_sensors(self):
+        """
+        Display the sensors.
+        """
+        
+        sensors = self.get_sensors_to_display(self.istart)
+        if self.poller:
+            self.poller.set_sensors([index for index, sensor in sensors])
+
+        if not self.boxes:
+            self.create_gauges()
+
+        values = self.get_values(sensors)
+        for slot in range(GAUGE_SLOTS):
+            visible = slot < len(values)
+            if visible:
+                (name, value, unit) = values[slot]
+                self.name_texts[slot].SetLabel(unit+"\n"+name)
+                self.shown[slot] = None
+                self.held[slot] = None
+                self.set_value(slot, sensors[slot][1], value)
+
+            # Unused slots stay in the grid, hidden
+            self.boxes[slot].Show(visible)
+            self.value_texts[slot].Show(visible)
+            self.name_texts[slot].Show(visible)
+           
+        self.Refresh()
+        self.Layout() 
+
     def refresh(self, event):
         sensors = self.get_sensors_to_display(self.istart)
         
-        itext = 0
-        for index, sensor in sensors:
+        values = self.get_values(sensors)
+        for slot, (name, value, unit) in enumerate(values):
+            self.set_value(slot, sensors[slot][1], value)
+
+        interval = self.refresh_interval(sensors)
+        if interval != self.timer.GetInterval():
+            self.timer.Start(interval)
 
-            (name, value, unit) = self.port.sensor(index)
-            if type(value) == float:
-                value = str("%.2f" % round(value, 3))
+    def refresh_interval(self, sensors):
+        """
+        Milliseconds between two refreshes: the shortest poll interval of the
+        shown sensors, within GAUGE_MIN_INTERVAL and SENSOR_REFRESH_TIMER.
+        """
+        if not self.poller or not sensors:
+            return SENSOR_REFRESH_TIMER
+        interval = min([self.poller.interval(index) for index, sensor in sensors])
+        interval = max(GAUGE_MIN_INTERVAL, interval)
+        return min(SENSOR_REFRESH_TIMER, int(interval * 1000))
 
-            if itext<len(self.texts):
-                self.texts[itext*2].SetLabel(str(value))
-            
-            itext += 1
+    def get_suppressed(self):
+        """
+        Updates held back per sensor short name, to tune DEADBANDS.
+        """
+        return self.suppressed
 
     def on_ctrl_c(self, event):
         self.GetParent().Close()
@@ -278,7 +534,7 @@ class CarberryPanelGauges(wx.Panel):
         self.paint(wx.PaintDC(self))
 
     def paint(self, dc):
-        dc.DrawBitmap(self.bitmap, 0, 0)     
+        paint_background(self, dc, self.bitmap)
 
 
 class CarberryMainPanel(wx.Panel):
@@ -295,18 +551,11 @@ class CarberryMainPanel(wx.Panel):
         super(CarberryMainPanel, self).__init__(*args, **kwargs)
 
         # Background image
-        image = wx.Image(BACKGROUND)
-        width, height = wx.GetDisplaySize() 
-        image = image.Scale(width, height, wx.IMAGE_QUALITY_HIGH)
-        self.bitmap = wx.BitmapFromImage(image) 
+        self.bitmap = get_background_bitmap()
         self.Bind(wx.EVT_PAINT, self.OnPaint)
 
         # Logo
-        bitmap = wx.Bitmap(SMALL_LOGO)
-        width, height = bitmap.GetSize()
-        image = wx.ImageFromBitmap(bitmap)
-        image = image.Scale(width/17, height/17, wx.IMAGE_QUALITY_HIGH)
-        bitmap = wx.BitmapFromImage(image)
+        bitmap = get_scaled_bitmap(SMALL_LOGO, LOGO_SCALE)
         control = wx.StaticBitmap(self, wx.ID_ANY, bitmap)
         control.SetPosition((10, 5))
 
@@ -350,21 +599,21 @@ class CarberryMainPanel(wx.Panel):
         if self.timer0:
             self.timer0.Stop()
 
-        # Connection
-        self.carberry_obd_connection = CarberryObdConnection()
+        # Connection, runs in its own thread and reports through on_debug
+        self.Connect(-1, -1, EVT_DEBUG_ID, self.on_debug)
+        self.carberry_obd_connection = CarberryObdConnection(self)
         self.carberry_obd_connection.connect()
-        connected = False
-        while not connected:
-            connected = self.carberry_obd_connection.is_connected()
-            self.textCtrl.Clear()
-            self.textCtrl.AddText(" Trying to connect ..." + time.asctime())
-            if connected: 
-                break
 
-        if not connected:
+    def on_debug(self, event):
+        """
+        Progress of the connection thread.
+        """
+        (position, message) = event.data
+
+        if position == CONNECTION_FAILED:
+            self.textCtrl.AddText(message + "\n")
             self.textCtrl.AddText(" Not connected\n")
-            return False
-        else:
+        elif position == CONNECTION_DONE:
             self.textCtrl.Clear()
             self.textCtrl.AddText(" Connected\n")
             port_name = self.carberry_obd_connection.get_port_name()
@@ -372,13 +621,17 @@ class CarberryMainPanel(wx.Panel):
                 self.textCtrl.AddText(" Failed Connection: " + port_name +"\n")
                 self.textCtrl.AddText(" Hold alt & esc to view terminal.")
 
-            self.textCtrl.AddText(str(self.carberry_obd_connection.get_output()))
+            self.textCtrl.AddText(message)
 
             #add a timer here to actually have time to see the list of supported sensors.
             self.sensors = self.carberry_obd_connection.get_sensors()
             self.port = self.carberry_obd_connection.get_port()
+            # this panel goes away, the port reports to the console from now on
+            self.port.notify_window = None
 
             self.GetParent().update(None)
+        else:
+            self.textCtrl.AddText(message + "\n")
 
     def getSensors(self):
         return self.sensors
@@ -387,13 +640,15 @@ class CarberryMainPanel(wx.Panel):
         return self.port
 
     def onCtrlC(self, event):
+        if self.carberry_obd_connection:
+            self.carberry_obd_connection.cancel()
         self.GetParent().Close()
 
     def OnPaint(self, event): 
         self.Paint(wx.PaintDC(self)) 
 
     def Paint(self, dc): 
-        dc.DrawBitmap(self.bitmap, 0, 0)
+        paint_background(self, dc, self.bitmap)
 
 
 class CarberryMainFrame(wx.Frame):
@@ -404,10 +659,7 @@ class CarberryMainFrame(wx.Frame):
         """
         wx.Frame.__init__(self, None, wx.ID_ANY, "OBD-Pi")
 
-        image = wx.Image(BACKGROUND)
-        width, height = wx.GetDisplaySize() 
-        image = image.Scale(width, height, wx.IMAGE_QUALITY_HIGH)
-        self.bitmap = wx.BitmapFromImage(image) 
+        self.bitmap = get_background_bitmap()
         self.Bind(wx.EVT_PAINT, self.OnPaint)
 
         self.main_panel = CarberryMainPanel(self)
@@ -432,6 +684,9 @@ class CarberryMainFrame(wx.Frame):
         if sensors:
             self.panelGauges.set_sensors(sensors)
             self.panelGauges.set_port(port)
+            if connection:
+                poller = connection.start_polling([index for index, sensor in sensors])
+                self.panelGauges.set_poller(poller)
         self.sizer = wx.BoxSizer(wx.VERTICAL)
         self.sizer.Add(self.panelGauges, 1, wx.EXPAND)
         self.SetSizer(self.sizer)
@@ -443,7 +698,7 @@ class CarberryMainFrame(wx.Frame):
         self.Paint(wx.PaintDC(self)) 
 
     def Paint(self, dc): 
-        dc.DrawBitmap(self.bitmap, 0, 0)
+        paint_background(self, dc, self.bitmap)
 
 
 class InitialFrame(wx.Frame):
@@ -457,17 +712,14 @@ class InitialFrame(wx.Frame):
         """
         wx.Frame.__init__(self, None, wx.ID_ANY, "")
 
-        image = wx.Image(BACKGROUND)
-        width, height = wx.GetDisplaySize() 
-        image = image.Scale(width, height, wx.IMAGE_QUALITY_HIGH)
-        self.bitmap = wx.BitmapFromImage(image) 
+        self.bitmap = get_background_bitmap()
         self.Bind(wx.EVT_PAINT, self.OnPaint)
 
     def OnPaint(self, event): 
         self.Paint(wx.PaintDC(self)) 
 
     def Paint(self, dc): 
-        dc.DrawBitmap(self.bitmap, 0, 0)
+        paint_background(self, dc, self.bitmap)
 
 
 class CarberryApp(wx.App):
@@ -495,5 +747,11 @@ class CarberryApp(wx.App):
         if event.GetEventType == wx.KeyEvent:
             pass
 
-app = CarberryApp(False)
-app.MainLoop()
+
+def main():
+    app = CarberryApp(False)
+    app.MainLoop()
+
+if __name__ == "__main__":
+    main()
+
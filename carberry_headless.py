@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# Taken before anything else is imported, startup time is measured from here
+import time
+START_TIME = time.time()
+
+import argparse
+import signal
+from threading import Event
+from carberry_io.carberry_capture import CarberryObdCapture
+from carberry_io.carberry_poller import CarberryObdPoller
+from carberry_io.carberry_monitor import CarberryCanMonitor, load_frame_map
+from carberry_io.carberry_logger import CarberryTripRecorder
+from carberry_io.carberry_archive import CarberryTripArchive
+from carberry_io.carberry_rate import CarberryRateController
+from carberry_io.carberry_stats import STATS_DUMP_INTERVAL
+from carberry_io.carberry_server import CarberryTelemetryServer, TELEMETRY_HOST, TELEMETRY_PORT
+
+
+# Constants
+TRIP_DIRECTORY = "trips"
+CONNECT_RETRY_DELAY = 5
+
+
+class CarberryHeadless(object):
+    """
+    Data logger without display: connects, polls every supported sensor in
+    the background and records the samples to trip files. With a frame map
+    it listens to the CAN broadcasts instead of polling.
+    """
+
+    def __init__(self, directory, duration=None, stats=False, frame_map=None, server=None, archive=None):
+        self.capture = CarberryObdCapture()
+        self.recorder = CarberryTripRecorder(directory)
+        self.duration = duration
+        self.stats = stats
+        self.frame_map = frame_map
+        # CarberryTelemetryServer sharing the samples, if any
+        self.server = server
+        # CarberryTripArchive also getting the samples with their raw replies, if any
+        self.archive = archive
+        self.poller = None
+        self.first_sample = None
+        self.stopped = Event()
+
+    def connect(self):
+        """
+        Try to connect until a port answers or the logger is stopped.
+        """
+        while not self.stopped.is_set():
+            self.capture.connect()
+            if self.capture.is_connected():
+                return True
+            print "Not connected, retrying in %d s" % CONNECT_RETRY_DELAY
+            self.stopped.wait(CONNECT_RETRY_DELAY)
+        return False
+
+    def on_sample(self, timestamp, values):
+        if self.first_sample is None:
+            self.first_sample = timestamp
+            print "First sample %.2f s after start" % (timestamp - START_TIME)
+        self.recorder.record_values(timestamp, values)
+
+    def run(self):
+        print "Imports done %.2f s after start" % (time.time() - START_TIME)
+        if not self.connect():
+            return
+
+        print "Connected %.2f s after start" % (time.time() - START_TIME)
+        if self.frame_map:
+            self.poller = CarberryCanMonitor(self.capture.is_connected(), self.frame_map)
+        else:
+            sensors = [index for index, sensor in self.capture.get_supported_sensors()]
+            self.poller = CarberryObdPoller(self.capture.is_connected(), sensors, rate_controller=CarberryRateController())
+        self.poller.add_listener(self.on_sample)
+        if self.archive:
+            if self.frame_map:
+                self.poller.add_listener(self.archive.record_values)
+            else:
+                self.poller.add_raw_listener(self.archive.record_values)
+        if self.server:
+            self.poller.add_listener(self.server.publish)
+            self.server.start()
+        if self.stats:
+            stats = self.capture.is_connected().enable_stats()
+            if not self.frame_map:
+                # the monitor has no tasks, its stats are printed at the end
+                self.poller.add_task(stats.dump, STATS_DUMP_INTERVAL)
+        self.poller.start()
+        started = time.time()
+
+        # short waits, a blocking wait would hold off the signal handlers
+        while not self.stopped.is_set():
+            if self.duration is not None and time.time() - started >= self.duration:
+                break
+            self.stopped.wait(1)
+        self.poller.stop()
+        self.poller.join()
+        if self.server:
+            self.server.stop()
+            self.server.join()
+        if self.stats:
+            self.capture.is_connected().stats.dump()
+        self.recorder.close()
+        if self.archive:
+            self.archive.close()
+        self.capture.is_connected().close()
+
+    def stop(self, signum=None, frame=None):
+        self.stopped.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record OBD sensors without a display")
+    parser.add_argument("-d", "--directory", default=TRIP_DIRECTORY, help="where trip files are written")
+    parser.add_argument("-t", "--duration", type=float, default=None, help="seconds to record, forever if not given")
+    parser.add_argument("-s", "--stats", action="store_true", help="print OBD link stats every %d s" % STATS_DUMP_INTERVAL)
+    parser.add_argument("-m", "--monitor", default=None, help="JSON frame map: listen to the CAN broadcasts instead of polling")
+    parser.add_argument("-p", "--serve", type=int, nargs="?", const=TELEMETRY_PORT, default=None,
+                        help="stream the samples to TCP clients on this port (%d if not given)" % TELEMETRY_PORT)
+    parser.add_argument("--host", default=TELEMETRY_HOST, help="address the telemetry server listens on")
+    parser.add_argument("-a", "--archive", default=None, help="trip archive also recording the raw replies, for carberry_redecode")
+    args = parser.parse_args()
+
+    frame_map = None
+    if args.monitor:
+        frame_map = load_frame_map(args.monitor)
+    server = None
+    if args.serve is not None:
+        server = CarberryTelemetryServer(args.host, args.serve)
+    archive = None
+    if args.archive:
+        archive = CarberryTripArchive(args.archive)
+    headless = CarberryHeadless(args.directory, args.duration, args.stats, frame_map, server, archive)
+    signal.signal(signal.SIGTERM, headless.stop)
+    signal.signal(signal.SIGINT, headless.stop)
+    headless.run()
+
+if __name__ == "__main__":
+    main()
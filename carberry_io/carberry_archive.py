@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from carberry_logger import read_trip, to_float, FLUSH_INTERVAL
+
+# An archive is a data file and its index. The data file starts with MAGIC,
+# followed by blocks of a single sensor: a header (BLOCK_MAGIC, sensor
+# index, number of samples, first and last timestamp) and then the
+# timestamps (double), the values (double) and the raw replies columns.
+# Samples of a sensor are appended in time order.
+MAGIC = "CBARCH2\n"
+BLOCK_MAGIC = "SBLK"
+BLOCK_HEADER = struct.Struct("<4sHIdd")
+
+# The index file (data file name + INDEX_EXTENSION) starts with INDEX_MAGIC
+# and holds an entry per block: sensor index, number of samples, first and
+# last timestamp and offset of the block in the data file. It is written
+# after the block, a block missing from it is found again by repair_index.
+INDEX_MAGIC = "CBAIDX1\n"
+INDEX_ENTRY = struct.Struct("<HIddQ")
+ARCHIVE_EXTENSION = ".cba"
+INDEX_EXTENSION = ".idx"
+
+# Samples kept in memory, all sensors together, before blocks are written
+ARCHIVE_BATCH_SIZE = 1024
+
+TIMESTAMP = struct.Struct("<d")
+
+# A raw reply is kept as a big endian 64 bit word: its length in the top
+# byte (0 when the sensor did not answer) and its first RAW_BYTES data
+# bytes as an integer below it, which is what the sensor conversions take
+RAW_BYTES = 7
+RAW_MASK = (1 << (RAW_BYTES * 8)) - 1
+NO_RAW = 0
+
+# Columns are written straight from array("d"), swapped on big endian hosts
+SWAP = sys.byteorder != "little"
+
+
+def block_size(count):
+    return BLOCK_HEADER.size + count * 24
+
+
+def raw_word(data):
+    """Returns the raw column word of the reply data bytes (None: no reply)"""
+    if not data:
+        return NO_RAW
+    data = data[:RAW_BYTES]
+    return (len(data) << (RAW_BYTES * 8)) | int(data.encode("hex"), 16)
+
+
+def raw_data(word):
+    """Returns the reply data bytes of a raw column word, None if there was no reply"""
+    # words read back from a column (NumPy, struct) are longs, "%*" wants an int
+    length = int(word >> (RAW_BYTES * 8))
+    if length == 0:
+        return None
+    return ("%0*X" % (length * 2, word & RAW_MASK)).decode("hex")
+
+
+def read_index(filename, position=0):
+    """Returns the index entries (sensor, count, first, last, offset) of the
+    archive from position in its index file, and the position after them"""
+    entries = []
+    try:
+        f = open(filename + INDEX_EXTENSION, "rb")
+    except IOError:
+        return entries, position
+    try:
+        if position == 0:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("Not an archive index: %s" % filename)
+            position = len(INDEX_MAGIC)
+        f.seek(position)
+        data = f.read()
+    finally:
+        f.close()
+
+    count = len(data) / INDEX_ENTRY.size
+    for i in range(count):
+        entries.append(INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size))
+    return entries, position + count * INDEX_ENTRY.size
+
+
+def repair_index(filename):
+    """Adds to the index the blocks of the data file it misses, after a
+    crash between writing a block and its entry. Drops a truncated last
+    block."""
+    entries, position = read_index(filename)
+    end = len(MAGIC)
+    if entries:
+        sensor, count, first, last, offset = entries[-1]
+        end = offset + block_size(count)
+
+    f = open(filename, "r+b")
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a trip archive: %s" % filename)
+        size = os.fstat(f.fileno()).st_size
+
+        missing = []
+        while end + BLOCK_HEADER.size <= size:
+            f.seek(end)
+            magic, sensor, count, first, last = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+            if magic != BLOCK_MAGIC or end + block_size(count) > size:
+                break
+            missing.append((sensor, count, first, last, end))
+            end += block_size(count)
+
+        if end < size:
+            f.truncate(end)
+    finally:
+        f.close()
+
+    index = open(filename + INDEX_EXTENSION, "ab")
+    try:
+        if position == 0:
+            index.write(INDEX_MAGIC)
+        for entry in missing:
+            index.write(INDEX_ENTRY.pack(*entry))
+    finally:
+        index.close()
+
+
+class CarberryTripArchive:
+    """ CarberryTripArchive appends samples to a trip archive, one block per
+    sensor at each flush. It takes the same record calls as
+    CarberryTripRecorder, record_values can be a CarberryObdPoller listener.
+    An archive can be read with CarberryArchiveReader while it is written."""
+
+    def __init__(self, filename, batch_size=ARCHIVE_BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        if os.path.exists(filename):
+            repair_index(filename)
+            self.data = open(filename, "ab")
+        else:
+            self.data = open(filename, "ab")
+            self.data.write(MAGIC)
+            self.data.flush()
+            index = open(filename + INDEX_EXTENSION, "wb")
+            index.write(INDEX_MAGIC)
+            index.close()
+        self.index = open(filename + INDEX_EXTENSION, "ab")
+        self.offset = os.path.getsize(filename)
+
+        # sensor index -> (timestamps, values, raw words) waiting to be written
+        self.pending = {}
+        self.pending_count = 0
+        self.last_flush = time.time()
+
+    def record(self, timestamp, sensor_index, value, raw=None):
+        """Adds one sample, with the data bytes of the reply it was decoded
+        from if known"""
+        if sensor_index not in self.pending:
+            self.pending[sensor_index] = (array("d"), array("d"), [])
+        timestamps, values, words = self.pending[sensor_index]
+        timestamps.append(timestamp)
+        values.append(to_float(value))
+        words.append(raw_word(raw))
+        self.pending_count += 1
+
+        if self.pending_count >= self.batch_size or timestamp - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def record_values(self, timestamp, values, raw=None):
+        """Adds the samples of a {sensor index: value} dict taken at
+        timestamp. raw maps sensor indexes to reply data bytes, see
+        CarberryObdPoller.add_raw_listener."""
+        raw = raw or {}
+        for sensor_index, value in values.items():
+            self.record(timestamp, sensor_index, value, raw.get(sensor_index))
+
+    def flush(self):
+        """Writes a block per sensor with pending samples, then their index entries"""
+        self.last_flush = time.time()
+        if not self.pending:
+            return
+
+        entries = []
+        for sensor_index in sorted(self.pending):
+            timestamps, values, words = self.pending[sensor_index]
+            count = len(timestamps)
+            first, last = timestamps[0], timestamps[-1]
+            if SWAP:
+                timestamps.byteswap()
+                values.byteswap()
+            entries.append(self.write_block(sensor_index, first, last, timestamps.tostring(),
+                                            values.tostring(), struct.pack(">%dQ" % count, *words)))
+        self.write_entries(entries)
+
+        self.pending = {}
+        self.pending_count = 0
+
+    def write_block(self, sensor_index, first, last, timestamps, values, words):
+        """Writes a block from its encoded columns, returns its index entry.
+        For bulk writers like carberry_redecode, which then index the
+        blocks with write_entries."""
+        count = len(timestamps) / 8
+        self.data.write(BLOCK_HEADER.pack(BLOCK_MAGIC, sensor_index, count, first, last))
+        self.data.write(timestamps)
+        self.data.write(values)
+        self.data.write(words)
+        entry = (sensor_index, count, first, last, self.offset)
+        self.offset += block_size(count)
+        return entry
+
+    def write_entries(self, entries):
+        """Flushes the blocks written with write_block and indexes them"""
+        # readers trust the index: blocks are out before their entries
+        self.data.flush()
+        for entry in entries:
+            self.index.write(INDEX_ENTRY.pack(*entry))
+        self.index.flush()
+
+    def sync(self):
+        """Pushes written blocks and entries to the disk"""
+        self.flush()
+        os.fsync(self.data.fileno())
+        os.fsync(self.index.fileno())
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+
+class CarberryArchiveReader:
+    """ CarberryArchiveReader answers time range queries on a trip archive.
+    Only the index is read, the data file is memory-mapped and a query
+    touches just the blocks of its sensor overlapping the range, found by
+    bisection. refresh() picks up what a CarberryTripArchive appended
+    since."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a trip archive: %s" % filename)
+        self.map = None
+        self.map_size = 0
+
+        # sensor index -> entries (count, first, last, offset) in time order,
+        # and the last timestamps of these entries, for bisection
+        self.entries = {}
+        self.lasts = {}
+        self.index_position = 0
+        self.refresh()
+
+    def refresh(self):
+        """Maps the data appended since the last refresh"""
+        size = os.fstat(self.file.fileno()).st_size
+        if size > self.map_size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+            self.map_size = size
+
+        entries, self.index_position = read_index(self.filename, self.index_position)
+        for n, (sensor, count, first, last, offset) in enumerate(entries):
+            if offset + block_size(count) > self.map_size:
+                # block written after the data was mapped, next refresh gets it
+                self.index_position -= INDEX_ENTRY.size * (len(entries) - n)
+                break
+            self.entries.setdefault(sensor, []).append((count, first, last, offset))
+            self.lasts.setdefault(sensor, []).append(last)
+
+    def sensors(self):
+        """Returns the indexes of the sensors in the archive"""
+        return sorted(self.entries)
+
+    def time_range(self, sensor_index):
+        """Returns (first, last) timestamps of the sensor, or None"""
+        entries = self.entries.get(sensor_index)
+        if not entries:
+            return None
+        return entries[0][1], entries[-1][2]
+
+    def ranges(self, sensor_index, start=None, end=None):
+        """Generator over the blocks of the sensor holding samples taken
+        between start and end (both included, None for no limit), as
+        (offset of the timestamps column, count, first sample, end sample).
+        The values column follows at offset + 8 * count, then the raw words."""
+        entries = self.entries.get(sensor_index, [])
+
+        # first block not over before start
+        i = 0
+        if start is not None:
+            i = bisect_left(self.lasts[sensor_index], start)
+
+        for count, first, last, offset in entries[i:]:
+            if end is not None and first > end:
+                break
+            column = offset + BLOCK_HEADER.size
+            low = 0
+            if start is not None and first < start:
+                low = self.bisect(column, count, start)
+            high = count
+            if end is not None and last > end:
+                high = self.bisect(column, count, end, True)
+            if low < high:
+                yield column, count, low, high
+
+    def samples(self, sensor_index, start=None, end=None):
+        """Returns the timestamps and values of the sensor samples taken
+        between start and end (both included, None for no limit), as two
+        array("d")"""
+        timestamps = array("d")
+        values = array("d")
+        for column, count, low, high in self.ranges(sensor_index, start, end):
+            timestamps.fromstring(self.map[column + low * 8:column + high * 8])
+            values.fromstring(self.map[column + (count + low) * 8:column + (count + high) * 8])
+        if SWAP:
+            timestamps.byteswap()
+            values.byteswap()
+        return timestamps, values
+
+    def raw_samples(self, sensor_index, start=None, end=None):
+        """Returns the timestamps (array("d")) and the raw reply words (list,
+        see raw_data) of the sensor samples taken between start and end"""
+        timestamps = array("d")
+        words = []
+        for column, count, low, high in self.ranges(sensor_index, start, end):
+            timestamps.fromstring(self.map[column + low * 8:column + high * 8])
+            words.extend(struct.unpack_from(">%dQ" % (high - low), self.map, column + (2 * count + low) * 8))
+        if SWAP:
+            timestamps.byteswap()
+        return timestamps, words
+
+    def bisect(self, column, count, timestamp, after=False):
+        """Internal use only: not a public interface"""
+        # position of the first sample at (or, if after, past) timestamp in
+        # the timestamps column starting at offset column
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) / 2
+            t = TIMESTAMP.unpack_from(self.map, column + mid * 8)[0]
+            if t < timestamp or (after and t == timestamp):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+def import_trip(trip_filename, archive):
+    """Appends the samples of a CarberryTripRecorder file to a
+    CarberryTripArchive, which must not hold later samples already"""
+    for timestamp, sensor_index, value in read_trip(trip_filename):
+        archive.record(timestamp, sensor_index, value)
+    archive.flush()
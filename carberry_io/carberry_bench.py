@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import carberry_sensors
+from carberry_io import CarberryObdPort
+from carberry_capture import CarberryObdCapture
+from carberry_poller import CarberryObdPoller
+from carberry_profile import discover_profile
+from carberry_transport import CarberrySimulatedElm, CarberryReplayTransport
+
+# Repetitions of each measurement
+BENCH_COUNT = 10
+
+
+def open_port(transport):
+    return CarberryObdPort(transport.name, None, 2, transport=transport)
+
+
+def bench_pid_latency(port, sensor_indexes, count=BENCH_COUNT):
+    """Returns {sensor index: (min, mean, max)} seconds of a single PID request"""
+    latencies = {}
+    for index in sensor_indexes:
+        times = []
+        for i in range(count):
+            start = time.time()
+            port.sensor(index)
+            times.append(time.time() - start)
+        latencies[index] = (min(times), sum(times) / len(times), max(times))
+    return latencies
+
+
+def bench_capture(port, sensors, count=BENCH_COUNT):
+    """Returns the samples/sec of CarberryObdCapture.capture_data"""
+    capture = CarberryObdCapture()
+    capture.port = port
+    capture.profile = discover_profile(port, "bench")
+    capture.supportedSensorList = sensors
+
+    start = time.time()
+    for i in range(count):
+        capture.capture_data()
+    return count * len(sensors) / (time.time() - start)
+
+
+def bench_refresh(port, sensors, count=BENCH_COUNT):
+    """Returns the samples/sec the gauge panel gets from the poller, for one
+    page of 6 sensors polled as fast as the port allows"""
+    page = [index for index, sensor in sensors[:6]]
+    intervals = dict([(sensor.short_name, 0) for sensor in carberry_sensors.SENSORS])
+    poller = CarberryObdPoller(port, page, intervals)
+    samples = []
+    poller.add_listener(lambda timestamp, values: samples.append(len(values)))
+
+    start = time.time()
+    for i in range(count):
+        poller.poll()
+    return sum(samples) / (time.time() - start)
+
+
+def run(transport, count=BENCH_COUNT):
+    port = open_port(transport)
+    if port.state == 0:
+        print "Could not open " + transport.name
+        return
+
+    sensors = discover_profile(port, "bench").supported_sensors()
+    print "%d supported sensors on %s" % (len(sensors), transport.name)
+
+    print "\nPer-PID latency (ms)       min    mean     max"
+    latencies = bench_pid_latency(port, [index for index, sensor in sensors], count)
+    for index, sensor in sensors:
+        (low, mean, high) = latencies[index]
+        print "%-22s %7.1f %7.1f %7.1f" % (sensor.short_name, low * 1000, mean * 1000, high * 1000)
+
+    for multi_pid in (True, False):
+        port.multi_pid = multi_pid
+        if multi_pid:
+            print "\nBatched requests"
+        else:
+            print "\nOne PID per request"
+        print "capture  %8.1f samples/sec" % bench_capture(port, sensors, count)
+        print "refresh  %8.1f samples/sec" % bench_refresh(port, sensors, count)
+
+    port.close()
+
+if __name__ == "__main__":
+    # replays a recorded session if given one, else simulates an adapter
+    if len(sys.argv) > 1:
+        run(CarberryReplayTransport(sys.argv[1]))
+    else:
+        run(CarberrySimulatedElm())
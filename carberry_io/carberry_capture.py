@@ -1,30 +1,93 @@
 #!/usr/bin/env python
 
 from datetime import datetime
-from utils.carberry_utils import scan_serial
-from carberry_io import CarberryObdPort
+from threading import Thread
+from Queue import Queue
+from utils.carberry_utils import scan_serial, load_last_port, save_last_port
+from carberry_io import CarberryObdPort, BAUD_RATE
+from utils.debug_event import debug_display
 import time
-import carberry_sensors
+from carberry_profile import get_profile, invalidate_profile
+
+# Serial timeout used while probing ports
+PROBE_TIMEOUT = 2
+
+
+def probe_port(portname, baud, notify_window, results):
+    """Opens portname and runs the ELM handshake, puts the port (or None if
+    the handshake blew up) in results"""
+    try:
+        port = CarberryObdPort(portname, notify_window, PROBE_TIMEOUT, baud=baud)
+    except Exception as e:
+        print portname, e
+        port = None
+    results.put(port)
+
+
+def close_ports(results, count):
+    """Closes the ports of the probes that lost the race"""
+    for i in range(count):
+        port = results.get()
+        if port:
+            port.close()
 
 
 class CarberryObdCapture:
-    def __init__(self):
+    def __init__(self, notify_window=None):
+        # window receiving the progress messages of the ports, see debug_display
+        self.notify_window = notify_window
         self.supportedSensorList = []
         self.port = None
+        self.profile = None
 
     def connect(self):
         portnames = scan_serial()
         print portnames
-        for port in portnames:
-            self.port = CarberryObdPort(port, None, 2)
-            if(self.port.State == 0):
+
+        # The port that worked last time is tried on its own first
+        last = load_last_port()
+        if last and last[0] in portnames:
+            portnames.remove(last[0])
+            self.port = CarberryObdPort(last[0], self.notify_window, PROBE_TIMEOUT, baud=last[1])
+            if self.port.state == 0:
                 self.port.close()
                 self.port = None
-            else:
-                break
+
+        # Then every other port at once, the first one to answer wins. The
+        # probes report to the console only: the losers go on after the
+        # winner is found, when notify_window may be gone already.
+        if self.port is None and portnames:
+            debug_display(self.notify_window, 1, "Probing " + ", ".join(portnames))
+            results = Queue()
+            for portname in portnames:
+                t = Thread(target=probe_port, args=(portname, BAUD_RATE, None, results))
+                t.daemon = True
+                t.start()
+
+            pending = len(portnames)
+            while pending and self.port is None:
+                port = results.get()
+                pending -= 1
+                if port is None:
+                    continue
+                if port.state == 0:
+                    port.close()
+                else:
+                    self.port = port
+                    self.port.notify_window = self.notify_window
+                    debug_display(self.notify_window, 1, "Adapter answered on " + port.port.name)
+
+            if pending:
+                t = Thread(target=close_ports, args=(results, pending))
+                t.daemon = True
+                t.start()
 
         if(self.port):
+            save_last_port(self.port.port.name, self.port.baud)
             print "Connected to " + self.port.port.name
+            self.load_profile()
+            for supportedSensor in self.supportedSensorList:
+                print "supported sensor index = " + str(supportedSensor[0]) + " " + str(supportedSensor[1].short_name)
             
     def is_connected(self):
         return self.port
@@ -32,42 +95,36 @@ class CarberryObdCapture:
     def get_supported_sensors(self):
         return self.supportedSensorList 
 
-    def capture_data(self):
+    def load_profile(self):
+        """Gets the vehicle profile (from the cache if possible) and the list
+        of supported sensors"""
+        self.profile = get_profile(self.port)
+        self.supportedSensorList = self.profile.supported_sensors()
 
-        text = ""
+    def invalidate_profile(self):
+        """Drops the cached vehicle profile and discovers it again"""
+        if self.profile:
+            invalidate_profile(self.profile.key)
+            self.profile = None
+        if self.port:
+            self.load_profile()
+
+    def capture_data(self):
 
-        #Find supported sensors - by getting PIDs from OBD
-        # its a string of binary 01010101010101 
-        # 1 means the sensor is supported
-        self.supported_sensor = self.port.sensor(0)[1]
-        self.supportedSensorList = []
-        self.unsupportedSensorList = []
-
-        # loop through PIDs binary
-        for i in range(0, len(self.supported_sensor)):
-            if self.supported_sensor[i] == "1":
-                # store index of sensor and sensor object
-                self.supportedSensorList.append([i+1, carberry_sensors.SENSORS[i+1]])
-            else:
-                self.unsupportedSensorList.append([i+1, carberry_sensors.SENSORS[i+1]])
-        
-        for supportedSensor in self.supportedSensorList:
-            text += "supported sensor index = " + str(supportedSensor[0]) + " " + str(supportedSensor[1].shortname) + "\n"
-        
-        time.sleep(3)
-        
         if(self.port is None):
             return None
 
+        if self.profile is None:
+            self.load_profile()
+
         #Loop until Ctrl C is pressed
         localtime = datetime.now()
         current_time = str(localtime.hour)+":"+str(localtime.minute)+":"+str(localtime.second)+"."+str(localtime.microsecond)
         #log_string = current_time + "\n"
         text = current_time + "\n"
 
-        for supportedSensor in self.supportedSensorList:
-            sensorIndex = supportedSensor[0]
-            (name, value, unit) = self.port.sensor(sensorIndex)
+        sensorIndexes = [supportedSensor[0] for supportedSensor in self.supportedSensorList]
+        for (name, value, unit) in self.port.sensors(sensorIndexes):
             text += name + " = " + str(value) + " " + str(unit) + "\n"
 
         return text
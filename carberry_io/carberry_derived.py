@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import carberry_sensors
+
+
+class CarberryDerivedSensors:
+    """ CarberryDerivedSensors computes the DERIVED_SENSORS from polled
+    values. It never talks to the port: record_values is meant to be a
+    CarberryObdPoller listener, and a derived sensor is only computed again
+    when one of its inputs changed."""
+
+    def __init__(self, derived=None):
+        self.derived = derived
+        if self.derived is None:
+            self.derived = carberry_sensors.DERIVED_SENSORS
+
+        # short name -> latest value, of inputs and derived sensors
+        self.inputs = {}
+
+        # short name -> derived sensors using it
+        self.dependents = {}
+        for sensor in self.derived:
+            for name in sensor.inputs:
+                self.dependents.setdefault(name, []).append(sensor)
+
+        # derived short name -> (name, value, unit, timestamp), replaced as a
+        # whole on every update like CarberryObdPoller.snapshot
+        self.snapshot = {}
+
+    def get_snapshot(self):
+        return self.snapshot
+
+    def input_indexes(self):
+        """Returns the indexes in SENSORS of the sensors the derived ones need"""
+        return [index for index, sensor in enumerate(carberry_sensors.SENSORS)
+                if sensor.short_name in self.dependents]
+
+    def record_values(self, timestamp, values):
+        """Takes the {sensor index: value} read at timestamp"""
+        changed = set()
+        for index, value in values.items():
+            name = carberry_sensors.SENSORS[index].short_name
+            if name in self.dependents and self.inputs.get(name) != value:
+                self.inputs[name] = value
+                changed.update(self.dependents[name])
+
+        if not changed:
+            return
+
+        # DERIVED_SENSORS is ordered so that inputs come before their users
+        snapshot = dict(self.snapshot)
+        for sensor in self.derived:
+            if sensor not in changed:
+                continue
+
+            args = [self.inputs.get(input_name) for input_name in sensor.inputs]
+            if not all([isinstance(arg, (int, long, float)) for arg in args]):
+                continue
+
+            value = sensor.function(*args)
+            snapshot[sensor.short_name] = (sensor.name, value, sensor.unit, timestamp)
+            if self.inputs.get(sensor.short_name) != value:
+                self.inputs[sensor.short_name] = value
+                changed.update(self.dependents.get(sensor.short_name, []))
+        self.snapshot = snapshot
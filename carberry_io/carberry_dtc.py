@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import time
+
+# Index in SENSORS of the monitor status (0101): MIL and number of DTCs
+DTC_STATUS_SENSOR = 1
+
+# Seconds between two reads of the monitor status
+DTC_CHECK_INTERVAL = 30
+
+
+class CarberryDtcMonitor:
+    """ CarberryDtcMonitor watches the trouble codes during a drive. It reads
+    the cheap monitor status (MIL and DTC count) and only fetches the full
+    mode 03/07 lists when the status changed. Listeners get the codes that
+    appeared and the ones that went away.
+
+    check() needs the port: register it with CarberryObdPoller.add_task so
+    it runs on the poller thread."""
+
+    def __init__(self):
+        # (count, mil) of the last status read, None before the first one
+        self.status = None
+        # [status, code] lists, as returned by CarberryObdPort.get_dtc
+        self.codes = []
+        self.last_check = None
+
+        # functions called with (timestamp, added codes, cleared codes)
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def get_codes(self):
+        return self.codes
+
+    def get_mil(self):
+        """Returns whether the check engine light is on, None if unknown"""
+        if self.status is None:
+            return None
+        return bool(self.status[1])
+
+    def check(self, port):
+        """Reads the monitor status, and the codes if the status changed"""
+        now = time.time()
+        self.last_check = now
+        data = port.sensor(DTC_STATUS_SENSOR)[1]
+        if not isinstance(data, list):
+            # NODATA / NORESPONSE
+            return
+
+        status = (data[0], data[1])
+        if status == self.status:
+            return
+        self.status = status
+
+        # pending (mode 07) codes are only refreshed along with the status
+        codes = port.get_dtc()
+        added = [c for c in codes if c not in self.codes]
+        cleared = [c for c in self.codes if c not in codes]
+        self.codes = codes
+
+        if added or cleared:
+            for listener in self.listeners:
+                listener(now, added, cleared)
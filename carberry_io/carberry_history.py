@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+from array import array
+from collections import deque
+
+# Samples kept per sensor
+HISTORY_CAPACITY = 600
+# Seconds covered by the min/max/mean/rate queries
+HISTORY_WINDOW = 60.0
+
+
+class CarberrySensorHistory:
+    """ CarberrySensorHistory keeps the last samples of one sensor in
+    preallocated ring buffers, and the min, max, mean and rate of change of
+    the samples of the last window seconds. Adding a sample is amortized
+    O(1), the queries are O(1)."""
+
+    def __init__(self, capacity=HISTORY_CAPACITY, window=HISTORY_WINDOW):
+        self.capacity = capacity
+        self.window = window
+        self.timestamps = array("d", [0.0] * capacity)
+        self.values = array("d", [0.0] * capacity)
+
+        # samples are numbered, sample n lives at n % capacity. The window
+        # holds samples start to end - 1, the ring end - capacity to end - 1.
+        self.start = 0
+        self.end = 0
+        self.total = 0.0
+        # sample numbers of increasing values (min) and decreasing values (max)
+        self.min_queue = deque()
+        self.max_queue = deque()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def add(self, timestamp, value):
+        # drop samples that left the window, and the one the ring is about
+        # to overwrite, while their slots still hold them
+        oldest = timestamp - self.window
+        while self.end > self.start and \
+                (self.end - self.start >= self.capacity or self.timestamp(self.start) < oldest):
+            self.total -= self.value(self.start)
+            if self.min_queue[0] == self.start:
+                self.min_queue.popleft()
+            if self.max_queue[0] == self.start:
+                self.max_queue.popleft()
+            self.start += 1
+
+        n = self.end
+        pos = n % self.capacity
+        self.timestamps[pos] = timestamp
+        self.values[pos] = value
+        self.end += 1
+        self.total += value
+
+        while self.min_queue and self.value(self.min_queue[-1]) >= value:
+            self.min_queue.pop()
+        self.min_queue.append(n)
+        while self.max_queue and self.value(self.max_queue[-1]) <= value:
+            self.max_queue.pop()
+        self.max_queue.append(n)
+
+    def value(self, n):
+        """Internal use only: not a public interface"""
+        return self.values[n % self.capacity]
+
+    def timestamp(self, n):
+        """Internal use only: not a public interface"""
+        return self.timestamps[n % self.capacity]
+
+    def last(self):
+        """Returns (timestamp, value) of the latest sample, or None"""
+        if self.end == 0:
+            return None
+        return self.timestamp(self.end - 1), self.value(self.end - 1)
+
+    def min(self):
+        if not self.min_queue:
+            return None
+        return self.value(self.min_queue[0])
+
+    def max(self):
+        if not self.max_queue:
+            return None
+        return self.value(self.max_queue[0])
+
+    def mean(self):
+        if self.end == self.start:
+            return None
+        return self.total / (self.end - self.start)
+
+    def rate(self):
+        """Change per second between the oldest and latest sample of the window"""
+        if self.end - self.start < 2:
+            return None
+        elapsed = self.timestamp(self.end - 1) - self.timestamp(self.start)
+        if elapsed <= 0:
+            return None
+        return (self.value(self.end - 1) - self.value(self.start)) / elapsed
+
+    def samples(self):
+        """Returns the (timestamp, value) samples still in the ring, oldest first"""
+        first = max(0, self.end - self.capacity)
+        return [(self.timestamp(n), self.value(n)) for n in range(first, self.end)]
+
+
+class CarberryHistory:
+    """ CarberryHistory holds a CarberrySensorHistory per sensor index. Its
+    record_values can be used as a CarberryObdPoller listener."""
+
+    def __init__(self, capacity=HISTORY_CAPACITY, window=HISTORY_WINDOW):
+        self.capacity = capacity
+        self.window = window
+        self.sensors = {}
+
+    def get(self, sensor_index):
+        """Returns the history of the sensor, or None if it has no sample yet"""
+        return self.sensors.get(sensor_index)
+
+    def record(self, timestamp, sensor_index, value):
+        # values that are not numbers (NODATA, bitstrings...) are not kept
+        if not isinstance(value, (int, long, float)):
+            return
+        if sensor_index not in self.sensors:
+            self.sensors[sensor_index] = CarberrySensorHistory(self.capacity, self.window)
+        self.sensors[sensor_index].add(timestamp, float(value))
+
+    def record_values(self, timestamp, values):
+        for sensor_index, value in values.items():
+            self.record(timestamp, sensor_index, value)
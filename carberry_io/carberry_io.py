@@ -3,62 +3,107 @@
 
 import serial
 import carberry_sensors
+import re
 import string
 import time
-from carberry_sensors import hex_to_int
+from carberry_sensors import hex_to_int, pid_supported, UNPACKERS
+from carberry_response import is_hex, parse_response, protocol_header_size, reply_prefix, find_reply, \
+    decode_pids, decode_dtcs, dtc_code
 from utils.debug_event import debug_display
+from carberry_logger import CarberryTripRecorder
+from carberry_stats import CarberryLinkStats
 
 # Constants
 
 GET_DTC_COMMAND = "03"
 CLEAR_DTC_COMMAND = "04"
 GET_FREEZE_DTC_COMMAND = "07"
+GET_VIN_COMMAND = "0902"
+GET_CALIBRATION_ID_COMMAND = "0904"
+GET_ECU_NAME_COMMAND = "090A"
+GET_PROTOCOL_COMMAND = "atdpn"
+SET_PROTOCOL_COMMAND = "atsp"
+# atspa<n>: try protocol n first, then search. Stored by the ELM as its
+# power on default, so it must not rule out the other protocols.
+SET_PROTOCOL_AUTO_COMMAND = "atspa"
+
+# Sent after reset: echo, linefeeds and spaces off, adaptive timing
+INIT_COMMANDS = ["ate0", "atl0", "ats0", "atat1"]
+
+# Headers tell apart the ECUs answering a request, they stay on unless the
+# protocol has headers parse_response does not know
+HEADERS_ON_COMMAND = "ath1"
+HEADERS_OFF_COMMAND = "ath0"
+
+BAUD_RATE = 38400
+
+# Seconds to wait for the ELM prompt before giving up on a reply
+RESULT_TIMEOUT = 5
+
+# SAE J1979 allows up to 6 PIDs in a single mode 01 request (CAN only)
+MAX_PIDS_PER_REQUEST = 6
+
+# atdpn protocol numbers of the CAN protocols, the others get one PID per request
+CAN_PROTOCOLS = "6789"
 
 
 def decrypt_dtc_code(code):
-    """Returns the 5-digit DTC code from hex encoding"""
-    dtc = []
-    current = code
-    for i in range(0,3):
-        if len(current)<4:
-            raise "Tried to decode bad DTC: %s" % code
-
-        # type code
-        tc = carberry_sensors.hex_to_int(current[0])
-        tc >>= 2
-
-        if tc == 0:
-            type = "P"
-        elif tc == 1:
-            type = "C"
-        elif tc == 2:
-            type = "B"
-        elif tc == 3:
-            type = "U"
-        else:
-            raise tc
-
-        dig1 = str(carberry_sensors.hex_to_int(current[0]) & 3)
-        dig2 = str(carberry_sensors.hex_to_int(current[1]))
-        dig3 = str(carberry_sensors.hex_to_int(current[2]))
-        dig4 = str(carberry_sensors.hex_to_int(current[3]))
-        dtc.append(type+dig1+dig2+dig3+dig4)
-        current = current[4:]
-    return dtc
+    """Returns the 5-digit DTC codes from hex encoding (3 codes, 4 digits each).
+    Raises ValueError on a bad encoding."""
+    if len(code) < 12 or not is_hex(code[:12]):
+        raise ValueError("Tried to decode bad DTC: %s" % code)
+    return [dtc_code(hex_to_int(code[i:i+4])) for i in range(0, 12, 4)]
+
+
+def split_multi_pid_response(response, data_bytes, header_size=0):
+    """Splits a mode 01 multi-PID reply into a dict {pid: data bytes}.
+    data_bytes maps each requested PID to the length of its data, see
+    parse_response for header_size. Raises ValueError if the reply can not
+    be matched against the requested PIDs."""
+    values = {}
+    for ecu, pid, data in decode_pids(parse_response(response, header_size), data_bytes):
+        # first ECU to answer wins
+        if pid not in values:
+            values[pid] = data
+    return values
 
 
 class CarberryObdPort:
      """ CarberryObdPort abstracts all communication with OBD-II device."""
 
-     def __init__(self, portnum, notify_window, SERTIMEOUT):
-         """Initializes port by resetting the device and gettings supported PIDs. """
+     def __init__(self, portnum, notify_window, SERTIMEOUT, result_timeout=RESULT_TIMEOUT, baud=BAUD_RATE, transport=None):
+         """Initializes port by resetting the device and gettings supported PIDs.
+         transport replaces the serial port opened on portnum, see carberry_transport. """
 
-         baud = 38400
+         self.baud = baud
          databits = 8
          parity = serial.PARITY_NONE
          stop_bits = 1
          to = SERTIMEOUT
          self.elm_version = "Unknown"
+         self.protocol = None
+
+         self.result_timeout = result_timeout
+
+         # cleared on a protocol other than CAN, or the first time the ECU
+         # rejects a multi-PID request or leaves it unanswered
+         self.multi_pid = True
+
+         # whether the expected response count is appended to mode 01 requests
+         self.response_count = False
+
+         # hex characters of the header of each reply line (see
+         # parse_response), None until the protocol is known, 0 once the
+         # headers are turned off
+         self.header_size = None
+
+         # CarberryLinkStats once enable_stats() was called, nothing is
+         # measured while it is None
+         self.stats = None
+
+         # {PID: reply data bytes, None without reply} of the last read of
+         # each sensor once keep_raw() was called
+         self.raw = None
 
          #state SERIAL is 1 connected, 0 disconnected (connection failed)
          self.state = 1
@@ -68,7 +113,10 @@ class CarberryObdPort:
          debug_display(self.notify_window, 1, "Opening interface (serial port)")
 
          try:
-             self.port = serial.Serial(portnum, baud, parity=parity, stopbits=stop_bits, bytesize=databits, timeout=to)
+             if transport is None:
+                 self.port = serial.Serial(portnum, baud, parity=parity, stopbits=stop_bits, bytesize=databits, timeout=to)
+             else:
+                 self.port = transport
              
          except serial.SerialException as e:
              print e
@@ -80,19 +128,19 @@ class CarberryObdPort:
          
          try:
             self.send_command("atz")   # initialize
-            time.sleep(1)
          except serial.SerialException:
             self.state = 0
             return None
-            
+
+         # the reset is done once the prompt shows up, get_result waits for it
          self.elm_version = self.get_result()
          if(self.elm_version is None):
             self.state = 0
             return None
          
          debug_display(self.notify_window, 2, "atz response:" + self.elm_version)
-         self.send_command("ate0")  # echo off
-         debug_display(self.notify_window, 2, "ate0 response:" + self.get_result())
+         self.init_profile()
+
          self.send_command("0100")
          ready = self.get_result()
          
@@ -101,18 +149,81 @@ class CarberryObdPort:
             return None
             
          debug_display(self.notify_window, 2, "0100 response:" + ready)
+         if "UNABLE TO CONNECT" in ready:
+            # the ELM is there, but no vehicle answers on any protocol
+            self.state = 0
+            return None
+
+         self.fix_protocol()
+
+         protocol = self.get_protocol()
+         if protocol and protocol[-1] not in CAN_PROTOCOLS:
+             self.multi_pid = False
+
+         if self.header_size is None:
+             self.header_size = protocol_header_size(protocol)
+             if self.header_size is None:
+                 self.header_size = 0
+                 self.send_command(HEADERS_OFF_COMMAND)
+                 self.get_result()
          return None
+
+     def init_profile(self):
+         """Internal use only: not a public interface"""
+         headers = HEADERS_ON_COMMAND
+         if self.header_size == 0:
+             headers = HEADERS_OFF_COMMAND
+         for cmd in INIT_COMMANDS + [headers]:
+             self.send_command(cmd)
+             r = self.get_result()
+             debug_display(self.notify_window, 2, cmd + " response:" + str(r))
+             if cmd == HEADERS_ON_COMMAND and (r is None or "OK" not in r):
+                 # adapter (or recorded session) without headers
+                 self.header_size = 0
+
+         # response counts appeared in ELM327 v1.3
+         version = re.search(r"v(\d+)\.(\d+)", self.elm_version)
+         if version:
+             self.response_count = (int(version.group(1)), int(version.group(2))) >= (1, 3)
+
+     def fix_protocol(self):
+         """Internal use only: not a public interface"""
+         # atdpn answers A<n> while the protocol is automatic, trying <n>
+         # first saves the search when the ELM loses the bus, and still
+         # finds another vehicle's protocol
+         protocol = self.get_protocol()
+         if protocol and len(protocol) == 2 and protocol[0] == "A":
+             self.send_command(SET_PROTOCOL_AUTO_COMMAND + protocol[1])
+             self.get_result()
+             self.protocol = protocol[1]
               
      def close(self):
          """ Resets device and closes all associated filehandles"""
          
-         if (self.port!= None) and self.state==1:
-            self.send_command("atz")
+         if self.port is not None:
+            if self.state == 1:
+                self.send_command("atz")
             self.port.close()
          
          self.port = None
          self.elm_version = "Unknown"
 
+     def enable_stats(self, stats=None):
+         """Starts measuring the link, returns the CarberryLinkStats"""
+         if stats is None:
+             stats = CarberryLinkStats()
+         self.stats = stats
+         return stats
+
+     def disable_stats(self):
+         self.stats = None
+
+     def keep_raw(self):
+         """Starts keeping the data bytes of the sensor replies in self.raw,
+         so that they can be recorded and decoded again later"""
+         if self.raw is None:
+             self.raw = {}
+
      def send_command(self, cmd):
          """Internal use only: not a public interface"""
          if self.port:
@@ -121,83 +232,151 @@ class CarberryObdPort:
              for c in cmd:
                  self.port.write(c)
              self.port.write("\r\n")
+             if self.stats:
+                 self.stats.sent(cmd)
              #debug_display(self._notify_window, 3, "Send command:" + cmd)
 
-     def interpret_result(self, code):
+     def parse(self, data):
          """Internal use only: not a public interface"""
-         # Code will be the string returned from the device.
-         # It should look something like this:
-         # '41 11 0 0\r\r'
-         
-         # 9 seems to be the length of the shortest valid response
-         if len(code) < 7:
-             #raise Exception("BogusCode")
-             print "boguscode?"+code
-         
-         # get the first thing returned, echo should be off
-         code = string.split(code, "\r")
-         code = code[0]
-         
-         #remove whitespace
-         code = string.split(code)
-         code = string.join(code, "")
-         
-         # there is no such sensor
-         if code[:6] == "NODATA":
-             return "NODATA"
-             
-         # first 4 characters are code from ELM
-         code = code[4:]
-         return code
-    
+         # messages of a reply, see parse_response
+         return parse_response(data, self.header_size or 0)
+
      def get_result(self):
          """Internal use only: not a public interface"""
 
-         repeat_count = 0
-         if self.port is not None:
-             buffer = ""
-             while True:
-                 c = self.port.read(1)
-                 if len(c) == 0:
-                    if(repeat_count == 5):
-                        break
-                    print "Got nothing\n"
-                    repeat_count = repeat_count + 1
-                    continue
-                    
-                 if c == '\r':
-                    continue
-                    
-                 if c == ">":
-                    break;
-
-                 #if something is in the buffer, add it
-                 if buffer != "" or c != ">":
-                    buffer = buffer + c
-                    
-             if(buffer == ""):
-                return None
-             return buffer
-         else:
-            debug_display(self.notify_window, 3, "NO self.port!")
-         return None
+         if self.port is None:
+             debug_display(self.notify_window, 3, "NO self.port!")
+             return None
+
+         buffer = bytearray()
+         empty_reads = 0
+         deadline = time.time() + self.result_timeout
+         while True:
+             # take whatever already arrived, or block (up to the port
+             # timeout) for the next byte
+             chunk = self.port.read(self.port.inWaiting() or 1)
+             if len(chunk) == 0:
+                 print "Got nothing\n"
+                 empty_reads += 1
+             else:
+                 buffer.extend(chunk)
+                 if ">" in chunk:
+                     break
+
+             if time.time() >= deadline:
+                 break
+
+         data = str(buffer)
+         prompt = data.find(">")
+         if prompt != -1:
+             data = data[:prompt]
+         if self.stats:
+             self.stats.received(len(buffer), empty_reads, prompt == -1)
+
+         # keep line boundaries, multi-line replies need them
+         lines = [line for line in data.replace("\n", "").split("\r") if line.strip() != ""]
+         if not lines:
+             return None
+         return string.join(lines, "\r")
+
+     def read_raw(self):
+         """Returns the bytes received so far, waiting up to the serial
+         timeout for the first one. For streams that do not end with a
+         prompt, like the CAN monitor (see carberry_monitor)."""
+         if self.port is None:
+             return ""
+         data = self.port.read(self.port.inWaiting() or 1)
+         if self.stats:
+             self.stats.received(len(data), 0, False)
+         return data
 
      # get sensor value from command
      def get_sensor_value(self, sensor):
          """Internal use only: not a public interface"""
          cmd = sensor.cmd
+         if self.response_count:
+             # single reply expected, the ELM returns as soon as it has it
+             cmd += "1"
          self.send_command(cmd)
          data = self.get_result()
+
+         if data == "?" and self.response_count:
+             # clone that claims a version it does not implement
+             self.response_count = False
+             if self.stats:
+                 self.stats.retried()
+             self.send_command(sensor.cmd)
+             data = self.get_result()
          
          if data:
-             data = self.interpret_result(data)
-             if data != "NODATA":
-                 data = sensor.value(data)
+             try:
+                 reply = find_reply(self.parse(data), sensor.cmd)
+             except ValueError:
+                 reply = None
+             if reply is None or len(reply) < sensor.data_bytes:
+                 # the conversions unpack exactly data_bytes bytes
+                 data = "NODATA"
+             else:
+                 data = sensor.decode(reply)
          else:
-             return "NORESPONSE"
-             
+             reply = None
+             data = "NORESPONSE"
+
+         if self.raw is not None:
+             self.raw[sensor.pid] = reply
+
+         if self.stats:
+             self.stats.result(sensor.cmd, data)
          return data
 
+     def get_sensor_values(self, sensor_indexes):
+         """Internal use only: not a public interface"""
+         sensors = [carberry_sensors.SENSORS[i] for i in sensor_indexes]
+         data_bytes = {}
+         cmd = "01"
+         for sensor in sensors:
+             if sensor.pid not in data_bytes:
+                 data_bytes[sensor.pid] = sensor.data_bytes
+                 cmd += sensor.pid
+
+         self.send_command(cmd)
+         data = self.get_result()
+         if data is None:
+             if self.stats:
+                 self.stats.result(cmd, "NORESPONSE")
+             return {}
+
+         try:
+             raw = split_multi_pid_response(data, data_bytes, self.header_size or 0)
+         except ValueError as e:
+             # ECU does not handle multi-PID requests, stop batching
+             debug_display(self.notify_window, 3, str(e))
+             self.multi_pid = False
+             if self.stats:
+                 self.stats.result(cmd, "NODATA")
+             return {}
+
+         if self.stats:
+             if raw:
+                 self.stats.batch_result(cmd, raw.keys())
+             else:
+                 self.stats.result(cmd, "NODATA")
+
+         missing = [pid for pid in data_bytes if pid not in raw]
+         if missing:
+             # NO DATA or part of the PIDs only: the ECU does not take
+             # batches, they would cost an extra round trip every time
+             debug_display(self.notify_window, 3, "No multi-PID reply for " + " ".join(missing))
+             self.multi_pid = False
+
+         values = {}
+         for index, sensor in zip(sensor_indexes, sensors):
+             if sensor.pid in raw and len(raw[sensor.pid]) >= sensor.data_bytes:
+                 values[index] = sensor.decode(raw[sensor.pid])
+                 if self.raw is not None:
+                     self.raw[sensor.pid] = raw[sensor.pid]
+         return values
+
      # return string of sensor name and value from sensor index
      def sensor(self, sensor_index):
          """Returns 3-tuple of given sensors. 3-tuple consists of
@@ -206,6 +385,111 @@ class CarberryObdPort:
          sensor_data = self.get_sensor_value(sensor)
          return sensor.name, sensor_data, sensor.unit
 
+     def sensors(self, sensor_indexes):
+         """Returns a list with the 3-tuple of each given sensor (see sensor()).
+         Up to MAX_PIDS_PER_REQUEST sensors are read with a single request,
+         sensors missing from the reply are read one by one."""
+         values = {}
+         if self.multi_pid:
+             for i in range(0, len(sensor_indexes), MAX_PIDS_PER_REQUEST):
+                 batch = sensor_indexes[i:i+MAX_PIDS_PER_REQUEST]
+                 if len(batch) > 1:
+                     values.update(self.get_sensor_values(batch))
+                 if not self.multi_pid:
+                     break
+
+         result = []
+         for index in sensor_indexes:
+             sensor = carberry_sensors.SENSORS[index]
+             if index in values:
+                 sensor_data = values[index]
+             else:
+                 sensor_data = self.get_sensor_value(sensor)
+             result.append((sensor.name, sensor_data, sensor.unit))
+         return result
+
+     def get_elm_version(self):
+         """Returns the ELM version string answered to atz"""
+         # drop the echoed command
+         return string.split(self.elm_version, "\r")[-1]
+
+     def get_protocol(self):
+         """Returns the OBD protocol number the ELM settled on (atdpn)"""
+         if self.protocol is None:
+             self.send_command(GET_PROTOCOL_COMMAND)
+             self.protocol = self.get_result()
+         return self.protocol
+
+     def get_vehicle_info(self, cmd):
+         """Returns the text the vehicle answers to the mode 09 request cmd
+         (0902, 0904...), without its padding, or None if it is not reported"""
+         self.send_command(cmd)
+         data = self.get_result()
+         if data is None:
+             return None
+
+         try:
+             messages = self.parse(data)
+         except ValueError:
+             return None
+
+         # CAN answers with a single message: 49 PID NN and the characters,
+         # older protocols with one message per 4 characters: 49 PID NN.
+         # Only the messages of the first ECU answering are kept.
+         prefix = reply_prefix(cmd)
+         ecus = [ecu for ecu, message in messages if message[:2] == prefix]
+         text = ""
+         for ecu, message in messages:
+             if message[:2] == prefix and ecu == ecus[0]:
+                 text += message[3:]
+
+         text = text.replace("\x00", "").strip()
+         if text == "" or not all(c in string.printable for c in text):
+             return None
+         return text
+
+     def get_vin(self):
+         """Returns the vehicle VIN (mode 09 PID 02), or None if it is not reported"""
+         vin = self.get_vehicle_info(GET_VIN_COMMAND)
+         if vin is None:
+             return None
+         vin = vin[-17:]
+         if len(vin) != 17 or not vin.isalnum():
+             return None
+         return vin
+
+     def get_calibration_id(self):
+         """Returns the ECU calibration IDs (mode 09 PID 04), or None"""
+         return self.get_vehicle_info(GET_CALIBRATION_ID_COMMAND)
+
+     def get_ecu_name(self):
+         """Returns the ECU name (mode 09 PID 0A), or None"""
+         return self.get_vehicle_info(GET_ECU_NAME_COMMAND)
+
+     def get_supported_pids(self):
+         """Returns {base PID: bitmask} of the supported mode 01 PIDs for each
+         range the ECU reports (0100, 0120, 0140...)"""
+         masks = {}
+         base = 0
+         while base <= 0xE0:
+             self.send_command("01%02X" % base)
+             data = self.get_result()
+             if data is None:
+                 break
+             try:
+                 mask = find_reply(self.parse(data), "01%02X" % base)
+             except ValueError:
+                 break
+             if mask is None or len(mask) < 4:
+                 break
+
+             masks[base] = UNPACKERS[4](mask)[0]
+             # the last PID of a range tells if the next range is supported
+             if not pid_supported(masks[base], base + 0x20, base):
+                 break
+             base += 0x20
+         return masks
+
      def sensor_names(self):
          """Internal use only: not a public interface"""
          names = []
@@ -214,51 +498,26 @@ class CarberryObdPort:
          return names
 
      def get_dtc(self):
-          """Returns a list of all pending DTC codes. Each element consists of
-          a 2-tuple: (DTC code (string), Code description (string) )"""
-          dtcLetters = ["P", "C", "B", "U"]
-          r = self.sensor(1)[1] #data
-          dtcNumber = r[0]
-          mil = r[1]
+          """Returns a list of all stored and pending DTC codes. Each element consists of
+          a 2-list: [Status ("Active" or "Passive"), DTC code (string)]"""
           DTCCodes = []
 
-          print "Number of stored DTC:" + str(dtcNumber) + " MIL: " + str(mil)
-          # get all DTC, 3 per mesg response
-          for i in range(0, ((dtcNumber+2)/3)):
-            self.send_command(GET_DTC_COMMAND)
-            res = self.get_result()
-            print "DTC result:" + res
-            for i in range(0, 3):
-                val1 = hex_to_int(res[3+i*6:5+i*6])
-                val2 = hex_to_int(res[6+i*6:8+i*6]) #get DTC codes from response (3 DTC each 2 bytes)
-                val  = (val1<<8)+val2 #DTC val as int
-                
-                if val==0: #skip fill of last packet
-                  break
-                   
-                DTCStr=dtcLetters[(val&0xC000)>14]+str((val&0x3000)>>12)+str((val&0x0f00)>>8)+str((val&0x00f0)>>4)+str(val&0x000f)
-                
-                DTCCodes.append(["Active",DTCStr])
-          
-          #read mode 7
-          self.send_command(GET_FREEZE_DTC_COMMAND)
-          res = self.get_result()
-          
-          if res[:7] == "NODATA": #no freeze frame
-            return DTCCodes
-          
-          print "DTC freeze result:" + res
-          for i in range(0, 3):
-              val1 = hex_to_int(res[3+i*6:5+i*6])
-              val2 = hex_to_int(res[6+i*6:8+i*6]) #get DTC codes from response (3 DTC each 2 bytes)
-              val  = (val1<<8)+val2 #DTC val as int
-                
-              if val==0: #skip fill of last packet
-                break
-                   
-              DTCStr=dtcLetters[(val&0xC000)>14]+str((val&0x3000)>>12)+str((val&0x0f00)>>8)+str((val&0x00f0)>>4)+str(val&0x000f)
-              DTCCodes.append(["Passive",DTCStr])
-              
+          # one request per mode returns every code, of every ECU
+          for status, cmd in (("Active", GET_DTC_COMMAND), ("Passive", GET_FREEZE_DTC_COMMAND)):
+              self.send_command(cmd)
+              res = self.get_result()
+              if res is None:
+                  continue
+
+              print "DTC result:" + res
+              try:
+                  codes = decode_dtcs(self.parse(res), cmd)
+              except ValueError:
+                  continue
+              for ecu, code in codes:
+                  if [status, code] not in DTCCodes:
+                      DTCCodes.append([status, code])
+
           return DTCCodes
               
      def clear_dtc(self):
@@ -267,16 +526,16 @@ class CarberryObdPort:
          r = self.get_result()
          return r
      
-     def log(self, sensor_index, filename): 
-          file = open(filename, "w")
-          start_time = time.time() 
-          if file:
-               data = self.sensor(sensor_index)
-               file.write("%s     \t%s(%s)\n" % \
-                         ("Time", string.strip(data[0]), data[2])) 
-               while 1:
+     def log(self, sensor_indexes, directory, duration=None):
+          """Records the given sensors to trip files in directory, for duration
+          seconds or until interrupted"""
+          recorder = CarberryTripRecorder(directory)
+          start_time = time.time()
+          try:
+               while duration is None or time.time() - start_time < duration:
+                    values = self.sensors(sensor_indexes)
                     now = time.time()
-                    data = self.sensor(sensor_index)
-                    line = "%.6f,\t%s\n" % (now - start_time, data[1])
-                    file.write(line)
-                    file.flush()
\ No newline at end of file
+                    for index, data in zip(sensor_indexes, values):
+                         recorder.record(now, index, data[1])
+          finally:
+               recorder.close()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import os
+import struct
+import time
+
+# Trip files start with MAGIC, followed by blocks. A block is a header
+# (BLOCK_MAGIC, number of samples) and then one column per field: all the
+# timestamps (double), all the sensor indexes (unsigned short) and all the
+# values (double, NaN when the sensor did not answer with a number).
+MAGIC = "CBTRIP1\n"
+BLOCK_MAGIC = "BLK0"
+BLOCK_HEADER = struct.Struct("<4sI")
+TRIP_EXTENSION = ".cbt"
+
+# Samples kept in memory before a block is written
+BATCH_SIZE = 512
+# Seconds between two writes, even if the batch is not full
+FLUSH_INTERVAL = 5.0
+# Seconds between two fsync, bounds what is lost on power cut
+FSYNC_INTERVAL = 30.0
+# A new file is started once the current one grows past this many bytes
+MAX_FILE_SIZE = 16 * 1024 * 1024
+
+NAN = float("nan")
+
+
+def to_float(value):
+    """Sensor values that are not numbers (NODATA, bitstrings...) become NaN"""
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    return NAN
+
+
+class CarberryTripRecorder:
+    """ CarberryTripRecorder writes timestamped samples of any number of
+    sensors to compact binary trip files, in batches."""
+
+    def __init__(self, directory, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 fsync_interval=FSYNC_INTERVAL, max_file_size=MAX_FILE_SIZE):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_file_size = max_file_size
+
+        self.timestamps = []
+        self.indexes = []
+        self.values = []
+
+        self.file = None
+        self.filename = None
+        self.file_size = 0
+        self.file_count = 0
+        self.last_flush = time.time()
+        self.last_fsync = self.last_flush
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open(self):
+        """Internal use only: not a public interface"""
+        self.file_count += 1
+        name = time.strftime("trip-%Y%m%d-%H%M%S") + "-%d" % self.file_count + TRIP_EXTENSION
+        self.filename = os.path.join(self.directory, name)
+        self.file = open(self.filename, "wb")
+        self.file.write(MAGIC)
+        self.file_size = len(MAGIC)
+
+    def record(self, timestamp, sensor_index, value):
+        """Adds one sample"""
+        self.timestamps.append(timestamp)
+        self.indexes.append(sensor_index)
+        self.values.append(to_float(value))
+
+        if len(self.timestamps) >= self.batch_size or timestamp - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def record_values(self, timestamp, values):
+        """Adds the samples of a {sensor index: value} dict taken at timestamp"""
+        for sensor_index, value in values.items():
+            self.record(timestamp, sensor_index, value)
+
+    def flush(self):
+        """Writes the pending samples as one block"""
+        count = len(self.timestamps)
+        now = time.time()
+        self.last_flush = now
+        if count == 0:
+            return
+
+        if self.file is None:
+            self.open()
+
+        block = BLOCK_HEADER.pack(BLOCK_MAGIC, count) + \
+            struct.pack("<%dd" % count, *self.timestamps) + \
+            struct.pack("<%dH" % count, *self.indexes) + \
+            struct.pack("<%dd" % count, *self.values)
+        self.file.write(block)
+        self.file_size += len(block)
+
+        self.timestamps = []
+        self.indexes = []
+        self.values = []
+
+        if now - self.last_fsync >= self.fsync_interval:
+            self.sync()
+
+        if self.file_size >= self.max_file_size:
+            self.rotate()
+
+    def sync(self):
+        """Pushes written blocks to the disk"""
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.last_fsync = time.time()
+
+    def rotate(self):
+        """Closes the current file, the next block starts a new one"""
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.flush()
+        self.rotate()
+
+
+def read_trip(filename):
+    """Generator over the (timestamp, sensor index, value) samples of a trip
+    file. Reads one block at a time, a truncated last block is ignored."""
+    f = open(filename, "rb")
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a trip file: %s" % filename)
+
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                break
+            magic, count = BLOCK_HEADER.unpack(header)
+            if magic != BLOCK_MAGIC:
+                raise ValueError("Corrupted trip file: %s" % filename)
+
+            data = f.read(count * 18)
+            if len(data) < count * 18:
+                break
+            timestamps = struct.unpack_from("<%dd" % count, data, 0)
+            indexes = struct.unpack_from("<%dH" % count, data, count * 8)
+            values = struct.unpack_from("<%dd" % count, data, count * 10)
+            for i in range(count):
+                yield timestamps[i], indexes[i], values[i]
+    finally:
+        f.close()
+
+
+def list_trips(directory):
+    """Returns the trip files of directory, oldest first"""
+    names = [n for n in os.listdir(directory) if n.endswith(TRIP_EXTENSION)]
+    names.sort()
+    return [os.path.join(directory, n) for n in names]
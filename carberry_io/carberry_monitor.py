@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import json
+import time
+from binascii import unhexlify
+from threading import Thread, Event
+import carberry_sensors
+from carberry_response import is_hex
+from carberry_io import SET_PROTOCOL_AUTO_COMMAND
+
+# Sent before monitoring: headers on to see the CAN identifiers, spaces and
+# CAN formatting off to get the raw 8 data bytes
+MONITOR_COMMANDS = ["ath1", "ats0", "atcaf0"]
+MONITOR_COMMAND = "atma"
+
+# Puts the ELM back to its defaults once the monitor stops
+DEFAULTS_COMMAND = "atd"
+
+
+def sensor_index(short_name):
+    """Returns the index in SENSORS of the sensor with the given short name"""
+    for index, sensor in enumerate(carberry_sensors.SENSORS):
+        if sensor.short_name == short_name:
+            return index
+    raise ValueError("Unknown sensor: %s" % short_name)
+
+
+class CarberryFrameField:
+    """ One sensor value carried by a broadcast CAN frame: length bytes from
+    start in the frame data. Without scale the bytes are decoded like the
+    mode 01 reply of the sensor, otherwise as an unsigned integer times
+    scale plus offset."""
+
+    def __init__(self, short_name, start, length, scale=None, offset=0.0, little_endian=False):
+        self.index = sensor_index(short_name)
+        self.sensor = carberry_sensors.SENSORS[self.index]
+        self.start = start
+        self.end = start + length
+        self.scale = scale
+        self.offset = offset
+        self.little_endian = little_endian
+        if scale is None and length != self.sensor.data_bytes:
+            raise ValueError("%s takes %d bytes, not %d" % (short_name, self.sensor.data_bytes, length))
+
+    def value(self, data):
+        """Returns the value in the frame data bytes, None if the frame is too short"""
+        raw = data[self.start:self.end]
+        if len(raw) < self.end - self.start:
+            return None
+        if self.scale is None:
+            return self.sensor.decode(raw)
+        if self.little_endian:
+            raw = raw[::-1]
+        return int(raw.encode("hex"), 16) * self.scale + self.offset
+
+
+def load_frame_map(filename):
+    """Reads a frame map from a JSON file like
+        {"0C9": [{"sensor": "rpm", "start": 1, "length": 2}],
+         "3E9": [{"sensor": "speed", "start": 0, "length": 2, "scale": 0.01}]}
+    and returns {CAN identifier: [CarberryFrameField]}"""
+    with open(filename) as f:
+        entries = json.load(f)
+
+    frame_map = {}
+    for can_id, fields in entries.items():
+        frame_map[str(can_id).upper()] = [
+            CarberryFrameField(str(field["sensor"]), field["start"], field["length"],
+                               field.get("scale"), field.get("offset", 0.0),
+                               field.get("little_endian", False))
+            for field in fields]
+    return frame_map
+
+
+def can_filter(can_ids):
+    """Returns the (filter, mask) hex strings of the ELM CAN filter (atcf,
+    atcm) letting all the identifiers through, and as few others as possible"""
+    width = len(can_ids[0])
+    values = [int(can_id, 16) for can_id in can_ids]
+    differ = 0
+    for value in values:
+        differ |= value ^ values[0]
+    mask = ~differ & ((1 << (width * 4)) - 1)
+    return "%0*X" % (width, values[0] & mask), "%0*X" % (width, mask)
+
+
+class CarberryCanMonitor(Thread):
+    """ CarberryCanMonitor is the passive alternative to CarberryObdPoller:
+    it puts the ELM in bus monitor mode (atma), filtered on the identifiers
+    of the frame map, and decodes the frames the car broadcasts as they
+    stream in. Nothing is requested, so cars broadcasting rpm or speed give
+    tens of updates per second.
+
+    It owns the port like the poller and offers the same get_snapshot and
+    listeners, with the values keyed by SENSORS index."""
+
+    def __init__(self, port, frame_map):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.port = port
+        self.frame_map = frame_map
+        # all identifiers of a map have the same size: 11 or 29 bit
+        self.id_size = len(frame_map.keys()[0])
+        self.stop_event = Event()
+
+        # bytes of the line not received yet
+        self.buffer = bytearray()
+        # set when the ELM left the monitor mode (BUFFER FULL)
+        self.restart = False
+
+        # sensor index -> (name, value, unit, timestamp), see CarberryObdPoller
+        self.snapshot = {}
+
+        # functions called from the monitor thread with (timestamp,
+        # {index: value}) for each decoded frame, they must not block
+        self.listeners = []
+
+    def get_snapshot(self):
+        return self.snapshot
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def start_monitor(self):
+        """Internal use only: not a public interface"""
+        can_id, mask = can_filter(self.frame_map.keys())
+        for cmd in MONITOR_COMMANDS + ["atcf" + can_id, "atcm" + mask]:
+            self.port.send_command(cmd)
+            self.port.get_result()
+        self.buffer = bytearray()
+        self.restart = False
+        self.port.send_command(MONITOR_COMMAND)
+
+    def stop_monitor(self):
+        """Internal use only: not a public interface"""
+        # any character ends the monitor mode, the prompt follows
+        self.port.send_command("")
+        self.port.get_result()
+
+        self.port.send_command(DEFAULTS_COMMAND)
+        self.port.get_result()
+        self.port.init_profile()
+        if self.port.protocol:
+            self.port.send_command(SET_PROTOCOL_AUTO_COMMAND + self.port.protocol)
+            self.port.get_result()
+
+    def feed(self, data, timestamp):
+        """Takes the bytes read from the port, decodes the complete lines"""
+        self.buffer.extend(data)
+        if ">" in self.buffer:
+            # prompt: the ELM left the monitor mode
+            self.restart = True
+        end = self.buffer.rfind("\r")
+        if end == -1:
+            return
+        lines = str(self.buffer[:end]).split("\r")
+        del self.buffer[:end+1]
+
+        for line in lines:
+            self.decode(line, timestamp)
+
+    def decode(self, line, timestamp):
+        """Internal use only: not a public interface"""
+        line = line.replace(" ", "")
+        fields = self.frame_map.get(line[:self.id_size])
+        if fields is None or not is_hex(line):
+            # other frames, or BUFFER FULL, CAN ERROR...
+            return
+
+        data = line[self.id_size:]
+        data = unhexlify(data[:len(data)/2*2])
+        values = {}
+        for field in fields:
+            value = field.value(data)
+            if value is not None:
+                values[field.index] = value
+        if not values:
+            return
+
+        snapshot = dict(self.snapshot)
+        for index, value in values.items():
+            sensor = carberry_sensors.SENSORS[index]
+            snapshot[index] = (sensor.name, value, sensor.unit, timestamp)
+        self.snapshot = snapshot
+
+        for listener in self.listeners:
+            listener(timestamp, values)
+
+    def run(self):
+        self.start_monitor()
+        try:
+            while not self.stop_event.is_set():
+                data = self.port.read_raw()
+                if data:
+                    self.feed(data, time.time())
+                if self.restart:
+                    self.start_monitor()
+        finally:
+            self.stop_monitor()
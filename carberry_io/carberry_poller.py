@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import time
+from threading import Thread, Event
+import carberry_sensors
+
+# Seconds between two reads of a sensor, by sensor short name
+POLL_INTERVALS = {
+    "rpm"            : 0.1,
+    "speed"          : 0.1,
+    "throttle_pos"   : 0.2,
+    "load"           : 0.5,
+    "maf"            : 0.5,
+    "temp"           : 10,
+    "intake_air_temp": 10,
+    "engine_time"    : 60,
+    "engine_mil_time": 60,
+    }
+
+DEFAULT_POLL_INTERVAL = 1.0
+
+# Seconds waited after a poll failed (link dropped, garbled reply...)
+# before trying again
+POLL_ERROR_DELAY = 1.0
+
+
+class CarberryObdPoller(Thread):
+    """ CarberryObdPoller owns a CarberryObdPort and reads sensors in the
+    background, each sensor at its own rate. Readers get the latest values
+    from get_snapshot() without ever waiting on the serial port.
+
+    With a CarberryRateController the intervals follow what the link can
+    carry instead of staying fixed.
+
+    A poll that fails does not end the thread: the error is printed, kept
+    in self.error until a poll succeeds again, and the poll retried after
+    POLL_ERROR_DELAY. The snapshot timestamps tell how old the values are."""
+
+    def __init__(self, port, sensor_indexes=None, intervals=None, rate_controller=None):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.port = port
+        self.intervals = intervals
+        if self.intervals is None:
+            self.intervals = POLL_INTERVALS
+        self.rate_controller = rate_controller
+        self.stop_event = Event()
+
+        # sensor index -> time the sensor has to be read again
+        self.due = {}
+        self.sensor_indexes = []
+        self.set_sensors(sensor_indexes or [])
+
+        # sensor index -> (name, value, unit, timestamp). The dict is replaced
+        # as a whole after each read, readers never see a half updated one.
+        self.snapshot = {}
+
+        # functions called from the poller thread with (timestamp, {index: value})
+        # after each read, they must not block
+        self.listeners = []
+        # same, called with the reply data bytes as well, see add_raw_listener
+        self.raw_listeners = []
+
+        # [function, interval, time due] of the tasks run with the port
+        self.tasks = []
+
+        # exception of the last poll, None once a poll went through
+        self.error = None
+        self.errors = 0
+
+    def set_sensors(self, sensor_indexes):
+        """Sets the sensor indexes to poll, new sensors are read right away"""
+        self.sensor_indexes = list(sensor_indexes)
+
+    def get_snapshot(self):
+        """Returns the latest values, see self.snapshot"""
+        return self.snapshot
+
+    def get_error(self):
+        """Returns the exception the last poll failed with, None if it went
+        through"""
+        return self.error
+
+    def interval(self, sensor_index):
+        sensor = carberry_sensors.SENSORS[sensor_index]
+        interval = self.intervals.get(sensor.short_name, DEFAULT_POLL_INTERVAL)
+        if self.rate_controller is None:
+            return interval
+        return self.rate_controller.interval(sensor.short_name, interval)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def add_raw_listener(self, listener):
+        """Adds a listener called with (timestamp, {index: value}, {index:
+        reply data bytes}), for recordings that can be decoded again"""
+        self.port.keep_raw()
+        self.raw_listeners.append(listener)
+
+    def remove_raw_listener(self, listener):
+        self.raw_listeners.remove(listener)
+
+    def add_task(self, task, interval):
+        """Calls task(port) from the poller thread every interval seconds, for
+        work that needs the port while the poller owns it"""
+        self.tasks.append([task, interval, 0])
+
+    def stop(self):
+        self.stop_event.set()
+
+    def poll(self):
+        """Reads all sensors that are due. Returns the time the next sensor is due"""
+        sensor_indexes = self.sensor_indexes
+        now = time.time()
+        due = [i for i in sensor_indexes if self.due.get(i, 0) <= now]
+
+        if due:
+            start = now
+            values = self.port.sensors(due)
+            now = time.time()
+            if self.rate_controller:
+                self.rate_controller.record(start, now, len(due))
+            snapshot = dict(self.snapshot)
+            sample = {}
+            for index, (name, value, unit) in zip(due, values):
+                snapshot[index] = (name, value, unit, now)
+                sample[index] = value
+                self.due[index] = now + self.interval(index)
+            self.snapshot = snapshot
+
+            for listener in self.listeners:
+                listener(now, sample)
+
+            if self.raw_listeners:
+                raw = dict((index, self.port.raw.get(carberry_sensors.SENSORS[index].pid)) for index in due)
+                for listener in self.raw_listeners:
+                    listener(now, sample, raw)
+
+        for task in self.tasks:
+            if task[2] <= now:
+                start = now
+                task[0](self.port)
+                now = time.time()
+                task[2] = now + task[1]
+                if self.rate_controller:
+                    self.rate_controller.record(start, now, 1)
+
+        deadlines = [self.due.get(i, 0) for i in sensor_indexes] + [task[2] for task in self.tasks]
+        if not deadlines:
+            return now + DEFAULT_POLL_INTERVAL
+        return min(deadlines)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                next_due = self.poll()
+                self.error = None
+            except Exception as e:
+                print "Poll failed:", e
+                self.error = e
+                self.errors += 1
+                next_due = time.time() + POLL_ERROR_DELAY
+            delay = next_due - time.time()
+            if delay > 0:
+                self.stop_event.wait(delay)
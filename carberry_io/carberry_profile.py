@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import json
+import os
+import re
+import carberry_sensors
+from carberry_sensors import pid_supported
+from utils.carberry_utils import CACHE_DIR
+
+PROFILE_DIR = os.path.join(CACHE_DIR, "profiles")
+
+# Bump when the stored format changes, older profiles are then ignored
+PROFILE_VERSION = 1
+
+
+class CarberryVehicleProfile:
+    """ CarberryVehicleProfile holds what has to be discovered once per
+    vehicle: the supported PID bitmaps, the ELM version and the protocol."""
+
+    def __init__(self, key, supported_pids=None, elm_version="Unknown", protocol=None):
+        # VIN, or an identity built from the ECU when there is no VIN, None
+        # when the vehicle has no identity and the profile is not cached
+        self.key = key
+        # base PID (0x00, 0x20, 0x40...) -> 32 bit mask, as returned by 01xx
+        self.supported_pids = supported_pids or {}
+        self.elm_version = elm_version
+        self.protocol = protocol
+
+    def supports(self, pid):
+        """Tells if the mode 01 pid (int) is supported by the vehicle"""
+        if pid == 0:
+            return True
+        base = (pid - 1) / 32 * 32
+        return pid_supported(self.supported_pids.get(base, 0), pid, base)
+
+    def supported_sensors(self):
+        """Returns [index, Sensor] for each supported sensor of SENSORS"""
+        sensors = []
+        for index, sensor in enumerate(carberry_sensors.SENSORS):
+            pid = int(sensor.pid, 16)
+            if pid != 0 and self.supports(pid):
+                sensors.append([index, sensor])
+        return sensors
+
+
+def profile_filename(key):
+    return os.path.join(PROFILE_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", key) + ".json")
+
+
+def load_profile(key):
+    """Returns the cached profile for key, or None"""
+    try:
+        with open(profile_filename(key)) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if data.get("version") != PROFILE_VERSION:
+        return None
+
+    supported_pids = {}
+    for base, mask in data["supported_pids"].items():
+        supported_pids[int(base, 16)] = mask
+    return CarberryVehicleProfile(key, supported_pids, data["elm_version"], data["protocol"])
+
+
+def save_profile(profile):
+    data = {
+        "version": PROFILE_VERSION,
+        "supported_pids": dict([("%02X" % base, mask) for base, mask in profile.supported_pids.items()]),
+        "elm_version": profile.elm_version,
+        "protocol": profile.protocol,
+        }
+    try:
+        if not os.path.isdir(PROFILE_DIR):
+            os.makedirs(PROFILE_DIR)
+        with open(profile_filename(profile.key), "w") as f:
+            json.dump(data, f)
+    except (IOError, OSError) as e:
+        print e
+
+
+def invalidate_profile(key):
+    """Forgets the cached profile for key, it is discovered again next time"""
+    if key is None:
+        return
+    try:
+        os.remove(profile_filename(key))
+    except OSError:
+        pass
+
+
+def discover_profile(port, key):
+    """Queries the vehicle behind port for a new profile"""
+    return CarberryVehicleProfile(key, port.get_supported_pids(), port.get_elm_version(), port.get_protocol())
+
+
+def vehicle_key(port):
+    """VIN of the vehicle behind port or, when the vehicle does not report
+    it, an identity of its ECU: calibration ID and ECU name. None when
+    neither is reported, the adapter alone does not tell vehicles apart."""
+    vin = port.get_vin()
+    if vin:
+        return vin
+    ecu = [info for info in (port.get_calibration_id(), port.get_ecu_name()) if info]
+    if not ecu:
+        return None
+    return "ecu_%s_%s" % ("_".join(ecu), port.get_protocol())
+
+
+def get_profile(port):
+    """Returns the vehicle profile, from the cache when possible. Vehicles
+    without identity are discovered every time."""
+    key = vehicle_key(port)
+    if key is None:
+        return discover_profile(port, key)
+    profile = load_profile(key)
+    if profile is None:
+        profile = discover_profile(port, key)
+        save_profile(profile)
+    return profile
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Share of the time the link should be busy, the rest absorbs slow replies
+TARGET_UTILIZATION = 0.8
+
+# Seconds of measurements between two adjustments
+RATE_WINDOW = 5.0
+
+# Bounds of the factor applied to the poll intervals, and its largest change
+# in a single adjustment
+MIN_RATE_SCALE = 0.25
+MAX_RATE_SCALE = 10.0
+MAX_RATE_STEP = 2.0
+
+# Longest interval (seconds) of critical sensors, by short name, whatever
+# the load on the link
+MAX_INTERVALS = {
+    "rpm"  : 0.5,
+    "speed": 0.5,
+    }
+
+
+class CarberryRateController:
+    """ CarberryRateController scales the poll intervals to what the link
+    can carry. The poller reports the time it spent talking to the port,
+    every RATE_WINDOW seconds the intervals are stretched or shrunk so that
+    the link stays busy TARGET_UTILIZATION of the time: a fast CAN adapter
+    gets polled more often, a slow K-line one stops falling behind.
+
+    Critical sensors (MAX_INTERVALS) are never polled less often than
+    their limit."""
+
+    def __init__(self, target=TARGET_UTILIZATION, window=RATE_WINDOW, max_intervals=None):
+        self.target = target
+        self.window = window
+        self.max_intervals = max_intervals
+        if self.max_intervals is None:
+            self.max_intervals = MAX_INTERVALS
+
+        # factor applied to the base intervals
+        self.scale = 1.0
+
+        # measurements of the current window
+        self.window_start = None
+        self.busy = 0.0
+        self.requests = 0
+
+        # results of the last complete window
+        self.utilization = None
+        self.round_trip = None
+
+    def interval(self, short_name, base):
+        """Returns the interval of the sensor, base is its nominal interval"""
+        interval = base * self.scale
+        limit = self.max_intervals.get(short_name)
+        if limit is not None and interval > limit:
+            return limit
+        return interval
+
+    def record(self, start, end, requests):
+        """Takes a stretch of time the poller spent on the link, and the
+        number of sensors or tasks it served"""
+        if self.window_start is None:
+            self.window_start = start
+        self.busy += end - start
+        self.requests += requests
+
+        elapsed = end - self.window_start
+        if elapsed >= self.window:
+            self.adjust(elapsed)
+
+    def adjust(self, elapsed):
+        """Internal use only: not a public interface"""
+        self.utilization = self.busy / elapsed
+        if self.requests:
+            self.round_trip = self.busy / self.requests
+
+        # utilization follows 1 / scale, so scaling by utilization / target
+        # brings it back on target
+        step = self.utilization / self.target
+        step = max(1 / MAX_RATE_STEP, min(MAX_RATE_STEP, step))
+        self.scale = max(MIN_RATE_SCALE, min(MAX_RATE_SCALE, self.scale * step))
+
+        self.window_start = None
+        self.busy = 0.0
+        self.requests = 0
+
+    def get_scale(self):
+        return self.scale
+
+    def get_utilization(self):
+        """Share of the last window spent on the link, None before the first one"""
+        return self.utilization
+
+    def get_round_trip(self):
+        """Mean seconds per sensor read in the last window, None before the first one"""
+        return self.round_trip
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import os
+import struct
+import sys
+import time
+from array import array
+import carberry_sensors
+from carberry_archive import CarberryTripArchive, CarberryArchiveReader, TIMESTAMP, RAW_BYTES, RAW_MASK, \
+    SWAP, INDEX_EXTENSION, raw_data
+from carberry_logger import to_float, NAN
+
+# NumPy is optional: without it columns are decoded one sample at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The new archive is written under a temporary name, renamed once complete
+TEMPORARY_EXTENSION = ".tmp"
+
+
+def decode_words(sensor, words, values):
+    """Decodes the raw reply words one at a time with the sensor conversion.
+    Samples without a usable reply keep their value from values. Returns
+    an array("d")."""
+    result = array("d", values)
+    for i, word in enumerate(words):
+        data = raw_data(word)
+        if data is None or len(data) < sensor.data_bytes:
+            continue
+        try:
+            result[i] = to_float(sensor.decode(data))
+        except (struct.error, TypeError, ValueError):
+            result[i] = NAN
+    return result
+
+
+def decode_column(sensor, words, values):
+    """Decodes a column of raw reply words (see carberry_archive.raw_word)
+    with the sensor conversion, applied to the whole column at once with
+    NumPy. Samples without a usable reply keep their value from values."""
+    if numpy is None:
+        return decode_words(sensor, words, values)
+
+    words = numpy.asarray(words, dtype=numpy.uint64)
+    result = numpy.array(values, dtype=numpy.float64)
+    if getattr(sensor.conversion, "raw", False):
+        # conversions of the raw bytes (bitstrings...) give no number anyway
+        return numpy.asarray(decode_words(sensor, words.tolist(), result))
+
+    lengths = (words >> numpy.uint64(RAW_BYTES * 8)).astype(numpy.int64)
+    valid = lengths >= sensor.data_bytes
+    # the conversions take the first data_bytes bytes of the reply
+    shifts = (numpy.where(valid, lengths - sensor.data_bytes, 0) * 8).astype(numpy.uint64)
+    codes = ((words & numpy.uint64(RAW_MASK)) >> shifts).astype(numpy.int64)
+
+    # the conversions are plain arithmetic, they take whole columns as well
+    decoded = numpy.asarray(sensor.conversion(codes[valid]), dtype=numpy.float64)
+    result[valid] = decoded
+    return result
+
+
+def copy_block(reader, archive, sensor_index, column, count, redecode):
+    """Internal use only: not a public interface"""
+    timestamps = reader.map[column:column + count * 8]
+    values = reader.map[column + count * 8:column + count * 16]
+    words = reader.map[column + count * 16:column + count * 24]
+    first = TIMESTAMP.unpack_from(timestamps, 0)[0]
+    last = TIMESTAMP.unpack_from(timestamps, (count - 1) * 8)[0]
+
+    if redecode:
+        sensor = carberry_sensors.SENSORS[sensor_index]
+        if numpy is not None:
+            decoded = decode_column(sensor, numpy.frombuffer(words, dtype=">u8"),
+                                    numpy.frombuffer(values, dtype="<f8"))
+            values = decoded.astype("<f8").tostring()
+        else:
+            old = array("d")
+            old.fromstring(values)
+            if SWAP:
+                old.byteswap()
+            decoded = decode_words(sensor, struct.unpack(">%dQ" % count, words), old)
+            if SWAP:
+                decoded.byteswap()
+            values = decoded.tostring()
+
+    return archive.write_block(sensor_index, first, last, timestamps, values, words)
+
+
+def redecode_archive(source, target, sensor_indexes=None):
+    """Writes to the new archive target the samples of source, with the
+    values of the given sensors (all of them if None) decoded again from
+    their raw replies with the current conversions. Samples recorded
+    without raw reply keep their value. Returns the number of samples.
+    target only appears once complete, a failure leaves nothing behind."""
+    if os.path.exists(target):
+        raise ValueError("Archive already exists: %s" % target)
+
+    temporary = target + TEMPORARY_EXTENSION
+    for filename in (temporary, temporary + INDEX_EXTENSION):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    reader = CarberryArchiveReader(source)
+    samples = 0
+    try:
+        archive = CarberryTripArchive(temporary)
+        try:
+            for sensor_index in reader.sensors():
+                redecode = sensor_indexes is None or sensor_index in sensor_indexes
+                entries = []
+                for column, count, low, high in reader.ranges(sensor_index):
+                    entries.append(copy_block(reader, archive, sensor_index, column, count, redecode))
+                    samples += count
+                archive.write_entries(entries)
+        finally:
+            archive.close()
+    except:
+        for filename in (temporary, temporary + INDEX_EXTENSION):
+            if os.path.exists(filename):
+                os.remove(filename)
+        raise
+    finally:
+        reader.close()
+
+    # the index first: an archive without its index is repaired when opened
+    os.rename(temporary + INDEX_EXTENSION, target + INDEX_EXTENSION)
+    os.rename(temporary, target)
+    return samples
+
+
+if __name__ == "__main__":
+
+    # carberry_redecode.py source.cba target.cba [sensor short names...]
+    names = sys.argv[3:]
+    indexes = None
+    if names:
+        indexes = [index for index, sensor in enumerate(carberry_sensors.SENSORS) if sensor.short_name in names]
+    start = time.time()
+    count = redecode_archive(sys.argv[1], sys.argv[2], indexes)
+    print "%d samples in %.2f s" % (count, time.time() - start)
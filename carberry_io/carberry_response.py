@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import string
+from binascii import unhexlify
+
+# First letter of a DTC, from its 2 highest bits
+DTC_LETTERS = "PCBU"
+
+# Hex characters of the CAN header in front of each line when headers are
+# on (ath1): 11-bit or 29-bit identifiers
+CAN_HEADER_11 = 3
+CAN_HEADER_29 = 8
+# and the 3 header bytes of the older protocols (J1850, ISO 9141, KWP2000)
+OBD_HEADER = 6
+
+# atdpn protocol number -> header size
+HEADER_SIZES = {
+    "1": OBD_HEADER, "2": OBD_HEADER, "3": OBD_HEADER, "4": OBD_HEADER, "5": OBD_HEADER,
+    "6": CAN_HEADER_11, "7": CAN_HEADER_29, "8": CAN_HEADER_11, "9": CAN_HEADER_29,
+    }
+
+
+def is_hex(text):
+    """Returns True if text only holds hex digits"""
+    for c in text:
+        if c not in string.hexdigits:
+            return False
+    return text != ""
+
+
+def protocol_header_size(protocol):
+    """Returns the header size of the lines of the protocol answered by
+    atdpn (6, A6...), None for protocols parse_response does not know"""
+    if not protocol:
+        return None
+    return HEADER_SIZES.get(protocol[-1])
+
+
+def parse_response(response, header_size=0):
+    """Splits an ELM reply into the messages it holds, as a list of
+    (ecu, data). data is the payload as a byte string, service byte first,
+    with ISO-TP frames put back together. ecu is the header of the lines
+    when header_size (hex characters: CAN_HEADER_11, CAN_HEADER_29 or
+    OBD_HEADER, see protocol_header_size()) says headers are on, None
+    otherwise. Status lines (SEARCHING..., NO DATA, BUS INIT...) are
+    skipped. Raises ValueError if the ELM rejected the command."""
+    # [ecu, hex parts, byte count or 0] in the order the messages started
+    messages = []
+    # ecu -> message still waiting for consecutive frames
+    pending = {}
+
+    for line in response.split("\r"):
+        line = line.replace(" ", "")
+        if line == "?":
+            raise ValueError("Command rejected by the ELM")
+
+        if header_size:
+            ecu = line[:header_size]
+            frame = line[header_size:]
+            if len(ecu) < header_size or not is_hex(line):
+                continue
+            pci = frame[0]
+            if pci == "0":
+                # single frame, low nibble is the byte count
+                messages.append([ecu, [frame[2:]], int(frame[1], 16)])
+            elif pci == "1":
+                # first frame, 12 bit byte count
+                message = [ecu, [frame[4:]], int(frame[1:4], 16)]
+                messages.append(message)
+                pending[ecu] = message
+            elif pci == "2" and ecu in pending:
+                pending[ecu][1].append(frame[2:])
+            elif pci not in "123":
+                # not CAN: the whole line is the message, checksum aside
+                messages.append([ecu, [frame[:-2]], 0])
+            continue
+
+        if len(line) > 1 and line[1] == ":" and line[0] in string.hexdigits:
+            # ISO-TP frame "N:", belongs to the message announced last
+            frame = line[2:]
+            if not pending or (line[0] == "0" and len(pending[None][1]) > 0):
+                message = [None, [], 0]
+                messages.append(message)
+                pending[None] = message
+            pending[None][1].append(frame)
+        elif not is_hex(line):
+            continue
+        elif len(line) == 3:
+            # byte count announcing a multi-frame message
+            message = [None, [], int(line, 16)]
+            messages.append(message)
+            pending[None] = message
+        else:
+            messages.append([None, [line], 0])
+
+    result = []
+    for ecu, parts, length in messages:
+        data = "".join(parts)
+        if length:
+            # drop the padding of the last frame
+            data = data[:length*2]
+        if not is_hex(data):
+            continue
+        result.append((ecu, unhexlify(data[:len(data)/2*2])))
+    return result
+
+
+def reply_prefix(cmd):
+    """Returns the bytes a positive reply to the hex command starts with"""
+    return chr(int(cmd[:2], 16) + 0x40) + unhexlify(cmd[2:])
+
+
+def find_reply(messages, cmd):
+    """Returns the data following the echo of cmd in the first message
+    answering it, or None"""
+    prefix = reply_prefix(cmd)
+    for ecu, data in messages:
+        if data.startswith(prefix):
+            return data[len(prefix):]
+    return None
+
+
+def decode_pids(messages, data_bytes):
+    """Returns the (ecu, pid, data) of the mode 01 replies in messages.
+    data_bytes maps each requested PID (2 hex characters) to the length of
+    its data. Raises ValueError if a reply can not be matched against the
+    requested PIDs."""
+    values = []
+    for ecu, message in messages:
+        if message[:1] != "\x41":
+            raise ValueError("Unexpected reply: %s" % message.encode("hex"))
+
+        pos = 1
+        while pos < len(message):
+            pid = "%02X" % ord(message[pos])
+            if pid not in data_bytes:
+                raise ValueError("Unexpected PID %s in reply" % pid)
+            end = pos + 1 + data_bytes[pid]
+            if end > len(message):
+                raise ValueError("Truncated reply: %s" % message.encode("hex"))
+            values.append((ecu, pid, message[pos+1:end]))
+            pos = end
+    return values
+
+
+def dtc_code(value):
+    """Returns the 5 character DTC (P0133...) of its 2 byte encoding"""
+    return DTC_LETTERS[value >> 14] + "%d%03X" % ((value >> 12) & 3, value & 0xFFF)
+
+
+def decode_dtcs(messages, mode):
+    """Returns the (ecu, code) of the DTCs in the replies to a mode 03, 07 or
+    0A request"""
+    service = chr(int(mode, 16) + 0x40)
+    codes = []
+    for ecu, message in messages:
+        if message[:1] != service:
+            continue
+        data = message[1:]
+        if len(data) % 2:
+            # CAN replies start with the number of codes
+            data = data[1:]
+        for i in range(0, len(data) - 1, 2):
+            value = (ord(data[i]) << 8) | ord(data[i+1])
+            if value == 0:
+                # fill of the last line
+                continue
+            codes.append((ecu, dtc_code(value)))
+    return codes
@@ -1,73 +1,100 @@
 #!/usr/bin/env python
 
+import struct
+import timeit
+from binascii import hexlify, unhexlify
+
+
+# Unpackers for the data bytes of a reply, by number of bytes
+UNPACKERS = {
+    1: struct.Struct(">B").unpack_from,
+    2: struct.Struct(">H").unpack_from,
+    4: struct.Struct(">I").unpack_from,
+    }
+
 
 def hex_to_int(hex_str):
-    i = eval("0x" + hex_str, {}, {})
-    return i
+    return int(hex_str, 16)
+
+
+def raw(function):
+    """Marks a sensor conversion that takes the raw data bytes instead of
+    their integer value"""
+    function.raw = True
+    return function
+
+
+def compile_decoder(function, data_bytes):
+    """Returns a function converting the raw data bytes of a reply with the
+    given sensor conversion"""
+    if getattr(function, "raw", False):
+        return function
+
+    unpack = UNPACKERS[data_bytes]
+
+    def decode(data):
+        return function(unpack(data)[0])
+    return decode
+
+
+# Conversions below take the data bytes as an unsigned big endian integer,
+# unless marked @raw
 
 
 def maf(code):
-    code = hex_to_int(code)
     return code * 0.00132276
 
 
 def throttle_pos(code):
-    code = hex_to_int(code)
     return code * 100.0 / 255.0
 
 
 # measured in kPa
 def intake_m_pres(code):
-    code = hex_to_int(code)
     return code / 0.14504
 
 
 def rpm(code):
-    code = hex_to_int(code)
     return code / 4
 
 
 def speed(code):
-    code = hex_to_int(code)
     return code / 1.609
 
 
 def percent_scale(code):
-    code = hex_to_int(code)
     return code * 100.0 / 255.0
 
 
 def timing_advance(code):
-    code = hex_to_int(code)
     return (code - 128) / 2.0
 
 
 def sec_to_min(code):
-    code = hex_to_int(code)
     return code / 60
 
 
 def temp(code):
-    code = hex_to_int(code)
     celsius = code - 40
     return celsius
 
 
-def cpass(code):
+@raw
+def cpass(data):
     # TODO: this
-    return code
+    return hexlify(data).upper()
 
 
 def fuel_trim_percent(code):
-    code = hex_to_int(code)
     return (code - 128) * 100 / 128
 
 
-def dtc_decrypt(code):
-    #first byte is byte after PID and without spaces
-    num = hex_to_int(code[:2]) #A byte
+@raw
+def dtc_decrypt(data):
+    (num, numB, numC, numD) = struct.unpack_from(">BBBB", data)
     res = []
 
+    #first byte is byte after PID
     if num & 0x80: # is mil light on
         mil = 1
     else:
@@ -79,96 +106,156 @@ def dtc_decrypt(code):
     res.append(num)
     res.append(mil)
 
-    numB = hex_to_int(code[2:4]) #B byte
-
     for i in range(0, 3):
         res.append(((numB >> i) & 0x01)+((numB >> (3+i)) & 0x02))
 
-    numC = hex_to_int(code[4:6]) #C byte
-    numD = hex_to_int(code[6:8]) #D byte
-
     for i in range(0, 7):
         res.append(((numC >> i) & 0x01)+(((numD >> i) & 0x01) << 1))
 
     res.append(((numD >> 7) & 0x01)) #EGR SystemC7  bit of different
 
-    #return res
-    return "#"
+    return res
+
+
+def bitmask_to_bitstring(mask, bits):
+    """Returns mask as a string of '0' and '1', most significant bit first"""
+    return bin(mask)[2:].zfill(bits)
 
 
 def hex_to_bitstring(hex_str):
-    bitstring = ""
-    for i in hex_str:
-        # silly type safety, we don't want to evaluate random stuff
-        if type('') == type(i):
-            v = eval("0x%s" % i)
-            if v & 8:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-            if v & 4:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-            if v & 2:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-            if v & 1:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-    return bitstring
+    return bitmask_to_bitstring(hex_to_int(hex_str), len(hex_str) * 4)
+
+
+@raw
+def supported_pids(data):
+    """Bitstring of the supported PIDs, the first character is the PID
+    after the one that was queried"""
+    return bitmask_to_bitstring(UNPACKERS[4](data)[0], 32)
+
+
+def pid_supported(mask, pid, base=0):
+    """Tells if pid is set in the integer bitmask returned for PID base
+    (0x00, 0x20, 0x40...)"""
+    offset = pid - base
+    if offset < 1 or offset > 32:
+        return False
+    return bool(mask & (1 << (32 - offset)))
 
 
 class Sensor:
-    def __init__(self, short_name, sensor_name, sensor_command, sensor_value_function, unit):
+    def __init__(self, short_name, sensor_name, sensor_command, sensor_value_function, unit, data_bytes):
         self.short_name = short_name
         self.name = sensor_name
         self.cmd = sensor_command
-        self.value = sensor_value_function
         self.unit = unit
+        # mode 01 PID (2 hex digits) and the number of data bytes the ECU
+        # answers with, needed to split multi-PID replies
+        self.pid = sensor_command[2:4]
+        self.data_bytes = data_bytes
+        self.conversion = sensor_value_function
+        # takes the raw data bytes of a reply
+        self.decode = compile_decoder(sensor_value_function, data_bytes)
+
+    def value(self, code):
+        """Converts the data of a reply given as hex digits"""
+        return self.decode(unhexlify(code))
 
 SENSORS = [
-    Sensor("pids"                  , "Supported PIDs"				, "0100" , hex_to_bitstring ,""       ),
-    Sensor("dtc_status"            , "S-S DTC Cleared"				, "0101" , dtc_decrypt      ,""       ),
-    Sensor("dtc_ff"                , "DTC C-F-F"					, "0102" , cpass            ,""       ),
-    Sensor("fuel_status"           , "Fuel System Stat"				, "0103" , cpass            ,""       ),
-    Sensor("load"                  , "Calc Load Value"				, "01041", percent_scale    ,""       ),    
-    Sensor("temp"                  , "Coolant Temp"					, "0105" , temp             ,"C"      ),
-    Sensor("short_term_fuel_trim_1", "S-T Fuel Trim"				, "0106" , fuel_trim_percent,"%"      ),
-    Sensor("long_term_fuel_trim_1" , "L-T Fuel Trim"				, "0107" , fuel_trim_percent,"%"      ),
-    Sensor("short_term_fuel_trim_2", "S-T Fuel Trim"				, "0108" , fuel_trim_percent,"%"      ),
-    Sensor("long_term_fuel_trim_2" , "L-T Fuel Trim"				, "0109" , fuel_trim_percent,"%"      ),
-    Sensor("fuel_pressure"         , "FuelRail Pressure"			, "010A" , cpass            ,""       ),
-    Sensor("manifold_pressure"     , "Intk Manifold"				, "010B" , intake_m_pres    ,"psi"    ),
-    Sensor("rpm"                   , "Engine RPM"					, "010C1", rpm              ,""       ),
-    Sensor("speed"                 , "Vehicle Speed"				, "010D1", speed            ,"MPH"    ),
-    Sensor("timing_advance"        , "Timing Advance"				, "010E" , timing_advance   ,"degrees"),
-    Sensor("intake_air_temp"       , "Intake Air Temp"				, "010F" , temp             ,"F"      ),
-    Sensor("maf"                   , "AirFlow Rate(MAF)"			, "0110" , maf              ,"lb/min" ),
-    Sensor("throttle_pos"          , "Throttle Position"			, "01111", throttle_pos     ,"%"      ),
-    Sensor("secondary_air_status"  , "2nd Air Status"				, "0112" , cpass            ,""       ),
-    Sensor("o2_sensor_positions"   , "Loc of O2 sensors"			, "0113" , cpass            ,""       ),
-    Sensor("o211"                  , "O2 Sensor: 1 - 1"				, "0114" , fuel_trim_percent,"%"      ),
-    Sensor("o212"                  , "O2 Sensor: 1 - 2"				, "0115" , fuel_trim_percent,"%"      ),
-    Sensor("o213"                  , "O2 Sensor: 1 - 3"				, "0116" , fuel_trim_percent,"%"      ),
-    Sensor("o214"                  , "O2 Sensor: 1 - 4"				, "0117" , fuel_trim_percent,"%"      ),
-    Sensor("o221"                  , "O2 Sensor: 2 - 1"				, "0118" , fuel_trim_percent,"%"      ),
-    Sensor("o222"                  , "O2 Sensor: 2 - 2"				, "0119" , fuel_trim_percent,"%"      ),
-    Sensor("o223"                  , "O2 Sensor: 2 - 3"				, "011A" , fuel_trim_percent,"%"      ),
-    Sensor("o224"                  , "O2 Sensor: 2 - 4"				, "011B" , fuel_trim_percent,"%"      ),
-    Sensor("obd_standard"          , "OBD Designation"				, "011C" , cpass            ,""       ),
-    Sensor("o2_sensor_position_b"  , "Loc of O2 sensor" 			, "011D" , cpass            ,""       ),
-    Sensor("aux_input"             , "Aux input status"				, "011E" , cpass            ,""       ),
-    Sensor("engine_time"           , "Engine Start MIN"				, "011F" , sec_to_min       ,"min"    ),
-    Sensor("engine_mil_time"       , "Engine Run MIL"				, "014D" , sec_to_min       ,"min"    ),
+    Sensor("pids"                  , "Supported PIDs"				, "0100" , supported_pids   ,""       , 4),
+    Sensor("dtc_status"            , "S-S DTC Cleared"				, "0101" , dtc_decrypt      ,""       , 4),
+    Sensor("dtc_ff"                , "DTC C-F-F"					, "0102" , cpass            ,""       , 2),
+    Sensor("fuel_status"           , "Fuel System Stat"				, "0103" , cpass            ,""       , 2),
+    Sensor("load"                  , "Calc Load Value"				, "0104" , percent_scale    ,""       , 1),
+    Sensor("temp"                  , "Coolant Temp"					, "0105" , temp             ,"C"      , 1),
+    Sensor("short_term_fuel_trim_1", "S-T Fuel Trim"				, "0106" , fuel_trim_percent,"%"      , 1),
+    Sensor("long_term_fuel_trim_1" , "L-T Fuel Trim"				, "0107" , fuel_trim_percent,"%"      , 1),
+    Sensor("short_term_fuel_trim_2", "S-T Fuel Trim"				, "0108" , fuel_trim_percent,"%"      , 1),
+    Sensor("long_term_fuel_trim_2" , "L-T Fuel Trim"				, "0109" , fuel_trim_percent,"%"      , 1),
+    Sensor("fuel_pressure"         , "FuelRail Pressure"			, "010A" , cpass            ,""       , 1),
+    Sensor("manifold_pressure"     , "Intk Manifold"				, "010B" , intake_m_pres    ,"psi"    , 1),
+    Sensor("rpm"                   , "Engine RPM"					, "010C" , rpm              ,""       , 2),
+    Sensor("speed"                 , "Vehicle Speed"				, "010D" , speed            ,"MPH"    , 1),
+    Sensor("timing_advance"        , "Timing Advance"				, "010E" , timing_advance   ,"degrees", 1),
+    Sensor("intake_air_temp"       , "Intake Air Temp"				, "010F" , temp             ,"F"      , 1),
+    Sensor("maf"                   , "AirFlow Rate(MAF)"			, "0110" , maf              ,"lb/min" , 2),
+    Sensor("throttle_pos"          , "Throttle Position"			, "0111" , throttle_pos     ,"%"      , 1),
+    Sensor("secondary_air_status"  , "2nd Air Status"				, "0112" , cpass            ,""       , 1),
+    Sensor("o2_sensor_positions"   , "Loc of O2 sensors"			, "0113" , cpass            ,""       , 1),
+    Sensor("o211"                  , "O2 Sensor: 1 - 1"				, "0114" , fuel_trim_percent,"%"      , 2),
+    Sensor("o212"                  , "O2 Sensor: 1 - 2"				, "0115" , fuel_trim_percent,"%"      , 2),
+    Sensor("o213"                  , "O2 Sensor: 1 - 3"				, "0116" , fuel_trim_percent,"%"      , 2),
+    Sensor("o214"                  , "O2 Sensor: 1 - 4"				, "0117" , fuel_trim_percent,"%"      , 2),
+    Sensor("o221"                  , "O2 Sensor: 2 - 1"				, "0118" , fuel_trim_percent,"%"      , 2),
+    Sensor("o222"                  , "O2 Sensor: 2 - 2"				, "0119" , fuel_trim_percent,"%"      , 2),
+    Sensor("o223"                  , "O2 Sensor: 2 - 3"				, "011A" , fuel_trim_percent,"%"      , 2),
+    Sensor("o224"                  , "O2 Sensor: 2 - 4"				, "011B" , fuel_trim_percent,"%"      , 2),
+    Sensor("obd_standard"          , "OBD Designation"				, "011C" , cpass            ,""       , 1),
+    Sensor("o2_sensor_position_b"  , "Loc of O2 sensor" 			, "011D" , cpass            ,""       , 1),
+    Sensor("aux_input"             , "Aux input status"				, "011E" , cpass            ,""       , 1),
+    Sensor("engine_time"           , "Engine Start MIN"				, "011F" , sec_to_min       ,"min"    , 2),
+    Sensor("engine_mil_time"       , "Engine Run MIL"				, "014D" , sec_to_min       ,"min"    , 2),
+    ]
+
+
+# Derived sensors, computed from the values of other sensors
+
+# stoichiometric air/fuel ratio and density (lb/gal) of gasoline
+AIR_FUEL_RATIO = 14.7
+FUEL_DENSITY = 6.17
+ATMOSPHERIC_KPA = 101.325
+
+
+def fuel_flow(maf, short_term_trim, long_term_trim):
+    # maf in lb/min, trims in %, result in gal/h
+    fuel = maf / AIR_FUEL_RATIO * (1 + (short_term_trim + long_term_trim) / 100.0)
+    return fuel * 60 / FUEL_DENSITY
+
+
+def fuel_economy(speed, flow):
+    # speed in MPH, flow in gal/h
+    if flow <= 0:
+        return 0.0
+    return speed / flow
+
+
+def boost(manifold_pressure):
+    # manifold_pressure comes as kPa / 0.14504, see intake_m_pres
+    kpa = manifold_pressure * 0.14504
+    return (kpa - ATMOSPHERIC_KPA) * 0.14504
+
+
+class DerivedSensor:
+    def __init__(self, short_name, sensor_name, inputs, function, unit):
+        self.short_name = short_name
+        self.name = sensor_name
+        # short names of the sensors (or derived sensors listed before this
+        # one) whose values are passed to function, in order
+        self.inputs = inputs
+        self.function = function
+        self.unit = unit
+
+DERIVED_SENSORS = [
+    DerivedSensor("fuel_flow"   , "Fuel Flow"       , ["maf", "short_term_fuel_trim_1", "long_term_fuel_trim_1"], fuel_flow   , "gal/h"),
+    DerivedSensor("fuel_economy", "Fuel Economy"    , ["speed", "fuel_flow"]                                    , fuel_economy, "MPG"  ),
+    DerivedSensor("boost"       , "Boost"           , ["manifold_pressure"]                                     , boost       , "psi"  ),
     ]
 
 
 def test():
     for i in SENSORS:
-        print i.name, i.value("F")
+        print i.name, i.value("F" * i.data_bytes * 2)
+
+
+def benchmark(count=100000):
+    """Times the decoding of each sensor, from hex digits and from raw bytes"""
+    for i in SENSORS:
+        code = "7F" * i.data_bytes
+        data = unhexlify(code)
+        from_hex = timeit.timeit(lambda: i.value(code), number=count)
+        from_raw = timeit.timeit(lambda: i.decode(data), number=count)
+        print "%-22s hex %6.3f us  raw %6.3f us" % \
+              (i.short_name, from_hex * 1e6 / count, from_raw * 1e6 / count)
 
 if __name__ == "__main__":
     test()
+    benchmark()
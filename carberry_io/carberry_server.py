@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import errno
+import fcntl
+import json
+import os
+import select
+import socket
+from collections import deque
+from threading import Thread
+import carberry_sensors
+
+# Where the server listens by default, open it to the car network with
+# host "0.0.0.0"
+TELEMETRY_HOST = "127.0.0.1"
+TELEMETRY_PORT = 35000
+
+# Lines kept for a client that does not keep up, older ones are dropped
+CLIENT_QUEUE = 50
+
+# Bytes of queued lines handed to a client socket in one send
+SEND_SIZE = 4096
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class CarberryTelemetryClient:
+    """ One subscriber of the server: the lines it has still to get, at
+    most CLIENT_QUEUE of them, and the part of the current line not sent."""
+
+    def __init__(self, sock, address, queue_size=CLIENT_QUEUE):
+        self.sock = sock
+        self.address = address
+        self.lines = deque(maxlen=queue_size)
+        self.buffer = ""
+        self.dropped = 0
+
+    def queue(self, line):
+        """Queues a line, called from the publishing thread"""
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+    def wants_write(self):
+        return self.buffer != "" or len(self.lines) > 0
+
+    def send(self):
+        """Sends what the socket takes without blocking. Returns False once
+        the client is gone."""
+        while len(self.buffer) < SEND_SIZE and self.lines:
+            self.buffer += self.lines.popleft()
+        try:
+            sent = self.sock.send(self.buffer)
+        except socket.error as e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        self.buffer = self.buffer[sent:]
+        return True
+
+
+class CarberryTelemetryServer(Thread):
+    """ CarberryTelemetryServer streams the polled samples over TCP to any
+    number of local clients (tablets, loggers...), so that they share one
+    adapter. Each sample is a line of JSON:
+        {"t": timestamp, "values": {"rpm": 1726, "speed": 31.0}}
+    with "source" added for the samples of CarberryCaptureSupervisor.
+
+    publish() is meant to be a CarberryObdPoller listener: it only queues
+    the line and never waits on a client. A client too slow to keep up
+    loses its oldest lines instead of piling them up."""
+
+    def __init__(self, host=TELEMETRY_HOST, port=TELEMETRY_PORT, queue_size=CLIENT_QUEUE):
+        Thread.__init__(self)
+        self.daemon = True
+        self.queue_size = queue_size
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(5)
+        self.listener.setblocking(False)
+
+        # written to by the publishing thread to wake up select
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            set_nonblocking(fd)
+
+        self.running = True
+        # replaced as a whole by the server thread, see CarberryObdPoller.snapshot
+        self.clients = ()
+
+    def get_address(self):
+        """Returns the (host, port) the server listens on"""
+        return self.listener.getsockname()
+
+    def get_clients(self):
+        return self.clients
+
+    def publish(self, timestamp, values, source=None):
+        """Queues the sample {sensor index: value} for every client"""
+        clients = self.clients
+        if not clients:
+            return
+
+        sample = {"t": timestamp, "values": dict(
+            (carberry_sensors.SENSORS[index].short_name, value) for index, value in values.items())}
+        if source is not None:
+            sample["source"] = source
+        line = json.dumps(sample) + "\n"
+
+        for client in clients:
+            client.queue(line)
+        self.wake()
+
+    def publish_tagged(self, timestamp, source, values):
+        """publish() as a CarberryCaptureSupervisor listener"""
+        self.publish(timestamp, values, source)
+
+    def wake(self):
+        """Internal use only: not a public interface"""
+        try:
+            os.write(self.wake_write, "x")
+        except OSError:
+            # the pipe is full and select wakes up anyway, or the server stopped
+            pass
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def accept(self):
+        """Internal use only: not a public interface"""
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        self.clients = self.clients + (CarberryTelemetryClient(sock, address, self.queue_size),)
+
+    def drop(self, client):
+        """Internal use only: not a public interface"""
+        client.sock.close()
+        self.clients = tuple(c for c in self.clients if c is not client)
+
+    def run(self):
+        while self.running:
+            clients = self.clients
+            readers = [self.listener, self.wake_read] + [c.sock for c in clients]
+            writers = [c.sock for c in clients if c.wants_write()]
+            readable, writable, failed = select.select(readers, writers, [], 1.0)
+
+            if self.wake_read in readable:
+                try:
+                    os.read(self.wake_read, 4096)
+                except OSError:
+                    pass
+            if self.listener in readable:
+                self.accept()
+
+            for client in clients:
+                if client.sock in readable:
+                    # clients only listen, anything read is dropped, nothing means closed
+                    try:
+                        data = client.sock.recv(4096)
+                    except socket.error:
+                        data = ""
+                    if data == "":
+                        self.drop(client)
+                        continue
+                if client.sock in writable and not client.send():
+                    self.drop(client)
+
+        for client in self.clients:
+            client.sock.close()
+        self.clients = ()
+        # the wake pipe stays open, a late publish() may still write to it
+        self.listener.close()
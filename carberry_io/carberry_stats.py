@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket
+# takes everything slower
+LATENCY_BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+
+# Seconds between two periodic dumps
+STATS_DUMP_INTERVAL = 60
+
+
+def command_key(cmd):
+    """Command without the response count appended to mode 01 requests"""
+    cmd = cmd.upper()
+    if cmd[:2] == "01" and len(cmd) % 2:
+        cmd = cmd[:-1]
+    return cmd
+
+
+def command_pids(key):
+    """Mode 01 requests (01XX) of each PID of a command key, several for
+    batched requests, none for other modes"""
+    if key[:2] != "01":
+        return []
+    return ["01" + key[i:i+2] for i in range(2, len(key) - 1, 2)]
+
+
+class CarberryCommandStats:
+    """ Latency histogram and result counters of one command."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.timeouts = 0
+        self.nodata = 0
+        self.noresponse = 0
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.buckets[bucket] += 1
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+
+def stats_dict(table):
+    """{key: CarberryCommandStats} as plain dicts"""
+    result = {}
+    for key, stats in table.items():
+        result[key] = {
+            "count": stats.count,
+            "mean": stats.mean(),
+            "min": stats.min,
+            "max": stats.max,
+            "buckets": list(stats.buckets),
+            "timeouts": stats.timeouts,
+            "nodata": stats.nodata,
+            "noresponse": stats.noresponse,
+            }
+    return result
+
+
+def report_table(title, table):
+    """Lines of the report for {key: CarberryCommandStats}"""
+    lines = ["%-14s %6s %8s %8s %8s %5s %6s %6s" %
+             (title, "count", "mean ms", "min ms", "max ms", "t/o", "nodata", "nores")]
+    for key in sorted(table):
+        stats = table[key]
+        if stats.count:
+            times = (stats.mean() * 1000, stats.min * 1000, stats.max * 1000)
+        else:
+            times = (0, 0, 0)
+        lines.append("%-14s %6d %8.1f %8.1f %8.1f %5d %6d %6d" %
+                     ((key, stats.count) + times + (stats.timeouts, stats.nodata, stats.noresponse)))
+    return lines
+
+
+class CarberryLinkStats:
+    """ CarberryLinkStats collects what goes on between CarberryObdPort and
+    the adapter: round trip latency per command, timeouts, empty reads,
+    retries, NODATA/NORESPONSE results and bytes in and out. A port only
+    records them once CarberryObdPort.enable_stats has been called.
+
+    Mode 01 round trips are also counted per PID, so a PID keeps one
+    histogram whatever it was batched with: a single-PID request counts in
+    full, a batched one only adds its latency to the PIDs the reply holds
+    (see batch_result). Failed batches stay with the batched command."""
+
+    def __init__(self):
+        self.started = time.time()
+        # command key -> CarberryCommandStats
+        self.commands = {}
+        # mode 01 request of a single PID (010C) -> CarberryCommandStats
+        self.pids = {}
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.empty_reads = 0
+        self.retries = 0
+
+        # command waiting for its reply, and when it was sent
+        self.pending = None
+        self.sent_at = 0
+        # (command key, latency) of the last batched request answered, until
+        # batch_result tells which PIDs the reply held
+        self.batch = None
+
+    def command(self, cmd):
+        key = command_key(cmd)
+        if key not in self.commands:
+            self.commands[key] = CarberryCommandStats()
+        return self.commands[key]
+
+    def pid(self, pid):
+        """Returns the stats of the mode 01 request of pid (010C...)"""
+        if pid not in self.pids:
+            self.pids[pid] = CarberryCommandStats()
+        return self.pids[pid]
+
+    def command_and_pid(self, cmd):
+        """Internal use only: not a public interface"""
+        # stats of the command, and of its PID if it reads a single one
+        key = command_key(cmd)
+        result = [self.command(key)]
+        pids = command_pids(key)
+        if len(pids) == 1:
+            result.append(self.pid(pids[0]))
+        return result
+
+    def sent(self, cmd):
+        self.pending = cmd
+        self.sent_at = time.time()
+        self.bytes_out += len(cmd) + 2
+
+    def received(self, size, empty_reads, timed_out):
+        self.bytes_in += size
+        self.empty_reads += empty_reads
+        if self.pending is None:
+            return
+        latency = time.time() - self.sent_at
+        for stats in self.command_and_pid(self.pending):
+            if timed_out:
+                stats.timeouts += 1
+            else:
+                stats.add(latency)
+
+        self.batch = None
+        key = command_key(self.pending)
+        if not timed_out and len(command_pids(key)) > 1:
+            self.batch = (key, latency)
+        self.pending = None
+
+    def batch_result(self, cmd, pids):
+        """Adds the latency of the batched request cmd to the PIDs (0C...)
+        its reply held"""
+        if self.batch is None or self.batch[0] != command_key(cmd):
+            return
+        for pid in pids:
+            self.pid("01" + pid).add(self.batch[1])
+        self.batch = None
+
+    def result(self, cmd, data):
+        """Counts NODATA / NORESPONSE results of cmd"""
+        for stats in self.command_and_pid(cmd):
+            if data == "NODATA":
+                stats.nodata += 1
+            elif data == "NORESPONSE":
+                stats.noresponse += 1
+
+    def retried(self):
+        self.retries += 1
+
+    def get_stats(self):
+        """Returns everything as a dict, for callers that want the numbers"""
+        return {
+            "elapsed": time.time() - self.started,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "empty_reads": self.empty_reads,
+            "retries": self.retries,
+            "commands": stats_dict(self.commands),
+            "pids": stats_dict(self.pids),
+            }
+
+    def report(self):
+        """Returns the stats as text"""
+        elapsed = time.time() - self.started
+        lines = ["Link stats over %.0f s: %d bytes out, %d bytes in, %d empty reads, %d retries" %
+                 (elapsed, self.bytes_out, self.bytes_in, self.empty_reads, self.retries)]
+        lines.extend(report_table("command", self.commands))
+        if self.pids:
+            lines.extend(report_table("pid", self.pids))
+        return "\n".join(lines)
+
+    def dump(self, port=None):
+        """Prints the report; takes the port so it can be a poller task"""
+        print self.report()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import heapq
+import itertools
+import sys
+import time
+from multiprocessing import Process, Queue, Event
+from Queue import Empty
+from threading import Thread
+import carberry_sensors
+from utils.carberry_utils import scan_serial
+from carberry_io import CarberryObdPort, BAUD_RATE
+from carberry_capture import PROBE_TIMEOUT
+from carberry_poller import CarberryObdPoller
+from carberry_profile import get_profile
+from carberry_rate import CarberryRateController
+
+# Seconds samples are held back so that the ones of slower sources can be
+# put in order before them
+MERGE_DELAY = 0.5
+
+
+def capture_worker(portname, baud, samples, stop, transport=None):
+    """Runs in its own process: opens portname, polls every sensor the
+    vehicle supports and puts (timestamp, portname, {index: value}) in the
+    samples queue until stop is set. (timestamp, portname, None) tells the
+    port is done, connected or not."""
+    port = None
+    poller = None
+    try:
+        port = CarberryObdPort(portname, None, PROBE_TIMEOUT, baud=baud, transport=transport)
+        if port.state == 0:
+            return
+
+        sensors = [index for index, sensor in get_profile(port).supported_sensors()]
+        poller = CarberryObdPoller(port, sensors, rate_controller=CarberryRateController())
+        poller.add_listener(lambda timestamp, values: samples.put((timestamp, portname, values)))
+        poller.start()
+
+        # short waits, a blocking wait would hold off the signal handlers
+        while not stop.is_set():
+            stop.wait(1)
+    except Exception as e:
+        print portname, e
+    finally:
+        if poller:
+            poller.stop()
+            poller.join()
+        if port:
+            port.close()
+        samples.put((time.time(), portname, None))
+
+
+class CarberryCaptureSupervisor(Thread):
+    """ CarberryCaptureSupervisor captures from several adapters at once:
+    each port gets its own worker process (see capture_worker), so a slow
+    adapter never holds back the others and the work spreads over the
+    cores. The samples of all the ports are merged back in time order and
+    handed to the listeners tagged with the port they came from.
+
+    Samples are held back MERGE_DELAY seconds to be put in order; one
+    arriving later than that is still passed on, out of order, and counted
+    in self.late."""
+
+    def __init__(self, portnames=None, baud=BAUD_RATE, delay=MERGE_DELAY, transports=None):
+        Thread.__init__(self)
+        self.daemon = True
+
+        # every serial port found when started if not given
+        self.portnames = portnames
+        self.baud = baud
+        self.delay = delay
+        # portname -> transport replacing the serial port, see carberry_transport
+        self.transports = transports or {}
+
+        self.samples = Queue()
+        self.stop_event = Event()
+        # portname -> worker Process
+        self.workers = {}
+        # ports whose worker did not say it is done
+        self.sources = set()
+
+        # (timestamp, sequence, portname, values) waiting to be passed on
+        self.pending = []
+        self.sequence = itertools.count()
+        self.last = 0
+        self.late = 0
+
+        # functions called from the supervisor thread with (timestamp,
+        # portname, {index: value}), in time order. They must not block.
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def get_sources(self):
+        """Returns the ports still being captured"""
+        return sorted(self.sources)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def start_workers(self):
+        """Internal use only: not a public interface"""
+        if self.portnames is None:
+            self.portnames = scan_serial()
+        for portname in self.portnames:
+            worker = Process(target=capture_worker,
+                             args=(portname, self.baud, self.samples, self.stop_event,
+                                   self.transports.get(portname)))
+            worker.daemon = True
+            worker.start()
+            self.workers[portname] = worker
+            self.sources.add(portname)
+
+    def release(self, until=None):
+        """Internal use only: not a public interface"""
+        # passes on the samples taken up to until, all of them if None
+        while self.pending and (until is None or self.pending[0][0] <= until):
+            timestamp, sequence, portname, values = heapq.heappop(self.pending)
+            if timestamp < self.last:
+                self.late += 1
+            self.last = max(self.last, timestamp)
+            for listener in self.listeners:
+                listener(timestamp, portname, values)
+
+    def run(self):
+        self.start_workers()
+        while self.sources:
+            try:
+                timestamp, portname, values = self.samples.get(timeout=self.delay)
+            except Empty:
+                # a worker that died without a word is done as well
+                for portname in list(self.sources):
+                    if not self.workers[portname].is_alive():
+                        self.sources.discard(portname)
+            else:
+                if values is None:
+                    self.sources.discard(portname)
+                else:
+                    heapq.heappush(self.pending, (timestamp, self.sequence.next(), portname, values))
+            self.release(time.time() - self.delay)
+
+        self.release()
+        for worker in self.workers.values():
+            worker.join()
+
+
+def print_sample(timestamp, portname, values):
+    for index, value in sorted(values.items()):
+        sensor = carberry_sensors.SENSORS[index]
+        print "%.3f %s %s = %s %s" % (timestamp, portname, sensor.name, value, sensor.unit)
+
+
+if __name__ == "__main__":
+
+    # captures from the given ports, or from every serial port, until Ctrl C
+    supervisor = CarberryCaptureSupervisor(sys.argv[1:] or None)
+    supervisor.add_listener(print_sample)
+    supervisor.start()
+    try:
+        while supervisor.is_alive():
+            supervisor.join(1)
+    except KeyboardInterrupt:
+        supervisor.stop()
+        supervisor.join()
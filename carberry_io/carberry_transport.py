@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+
+import json
+import time
+from binascii import hexlify
+
+# Transports stand in for serial.Serial under CarberryObdPort: they offer
+# write, read, inWaiting, flushInput, flushOutput and close, plus the name
+# and portstr attributes.
+
+# Seconds a simulated adapter takes to answer a command
+SIMULATED_LATENCY = 0.05
+# Seconds per character on the wire (10 bits at 38400 baud)
+SIMULATED_CHAR_TIME = 10.0 / 38400
+
+# Data bytes answered by the simulated vehicle, by mode 01 PID
+SIMULATED_VALUES = {
+    0x01: "00076500",   # no DTC, MIL off
+    0x03: "0200",
+    0x04: "40",
+    0x05: "5A",         # 50 C
+    0x06: "80",
+    0x07: "82",
+    0x0B: "64",
+    0x0C: "1AF8",       # 1726 rpm
+    0x0D: "32",
+    0x0E: "90",
+    0x0F: "46",
+    0x10: "01F4",
+    0x11: "33",
+    0x13: "03",
+    0x14: "5A80",
+    0x15: "5A80",
+    0x1C: "06",
+    0x1F: "0258",
+    0x4D: "0000",
+    }
+
+SIMULATED_VIN = "1CARBERRYSIM00001"
+SIMULATED_CALIBRATION_ID = "CBSIM-CAL-0001"
+SIMULATED_ECU_NAME = "ECM-EngineControl"
+SIMULATED_DTC = ["0133", "0300"]
+SIMULATED_PENDING_DTC = ["0171"]
+
+# ECU answering the simulated requests, shown when headers are on
+SIMULATED_HEADER = "7E8"
+
+# (CAN identifier, 8 data bytes) of the frames the simulated vehicle
+# broadcasts in turn, seen in monitor mode (atma), and the seconds between
+# two frames
+SIMULATED_BROADCASTS = [
+    ("0C9", "001AF80000000000"),    # 1726 rpm in bytes 1-2
+    ("3E9", "3200000000000000"),    # 50 km/h in byte 0
+    ("1F5", "0400000000000000"),
+    ]
+SIMULATED_BROADCAST_INTERVAL = 0.005
+
+
+def supported_pids_mask(values, base):
+    """Bitmask of the PIDs of values in the range after base, as answered to 01xx"""
+    mask = 0
+    for pid in values:
+        if base < pid <= base + 0x20:
+            mask |= 1 << (base + 0x20 - pid)
+    # the next range is supported if any PID lies in it
+    for pid in values:
+        if pid > base + 0x20:
+            mask |= 1
+            break
+    return "%08X" % mask
+
+
+class CarberrySimulatedElm:
+    """ CarberrySimulatedElm behaves like an ELM327 connected to a CAN
+    vehicle, answering with a configurable latency."""
+
+    def __init__(self, values=None, latency=SIMULATED_LATENCY, char_time=SIMULATED_CHAR_TIME,
+                 multi_pid=True, vin=SIMULATED_VIN, dtc=None, pending_dtc=None,
+                 calibration_id=SIMULATED_CALIBRATION_ID, ecu_name=SIMULATED_ECU_NAME):
+        self.name = "simulated"
+        self.portstr = self.name
+        self.timeout = 2
+
+        self.values = values
+        if self.values is None:
+            self.values = SIMULATED_VALUES
+        self.latency = latency
+        self.char_time = char_time
+        self.multi_pid = multi_pid
+        # mode 09 answers, None when the vehicle does not report them
+        self.info = {"02": (vin, 17), "04": (calibration_id, 16), "0A": (ecu_name, 20)}
+        self.dtc = dtc
+        if self.dtc is None:
+            self.dtc = SIMULATED_DTC
+        self.pending_dtc = pending_dtc
+        if self.pending_dtc is None:
+            self.pending_dtc = SIMULATED_PENDING_DTC
+
+        self.reset()
+
+        self.command = ""
+        self.output = ""
+        # time at which the pending output can be read
+        self.ready_at = 0
+
+    def reset(self):
+        self.echo = True
+        self.spaces = True
+        self.linefeeds = False
+        self.headers = False
+        # atcf / atcm as integers, None while not set
+        self.can_filter = None
+        self.can_mask = None
+        self.monitoring = False
+
+    # serial.Serial interface
+
+    def write(self, data):
+        if self.monitoring and data:
+            # any character stops the monitor, and is lost
+            self.monitoring = False
+            self.output += "\r>"
+            self.ready_at = time.time()
+            return
+        for c in data:
+            if c == "\r":
+                self.answer(self.command.strip())
+                self.command = ""
+            elif c != "\n":
+                self.command += c
+
+    def inWaiting(self):
+        if self.monitoring:
+            self.broadcast()
+        if time.time() < self.ready_at:
+            return 0
+        return len(self.output)
+
+    def read(self, size=1):
+        if self.monitoring:
+            if not self.output:
+                time.sleep(max(0, min(self.timeout, self.monitor_next - time.time())))
+            self.broadcast()
+        if self.output and time.time() < self.ready_at:
+            delay = self.ready_at - time.time()
+            if delay > self.timeout:
+                time.sleep(self.timeout)
+                return ""
+            time.sleep(delay)
+        data = self.output[:size]
+        self.output = self.output[size:]
+        return data
+
+    def flushInput(self):
+        self.output = ""
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+    # ELM327 behaviour
+
+    def answer(self, command):
+        """Internal use only: not a public interface"""
+        command_key = command.upper().replace(" ", "")
+        eol = "\r"
+        if self.linefeeds:
+            eol = "\r\n"
+        output = ""
+        if self.echo:
+            output += command + eol
+
+        if command_key == "ATMA":
+            # frames stream in until the next character, no prompt
+            self.monitoring = True
+            self.monitor_next = time.time()
+            self.monitor_frame = 0
+            self.output = output
+            self.ready_at = time.time()
+            return
+
+        for line in self.reply(command_key):
+            output += line + eol
+        output += eol + ">"
+
+        self.output = output
+        self.ready_at = time.time() + self.latency + len(output) * self.char_time
+
+    def format_bytes(self, data):
+        """Internal use only: not a public interface"""
+        pairs = [data[i:i+2] for i in range(0, len(data), 2)]
+        if self.spaces:
+            return " ".join(pairs)
+        return "".join(pairs)
+
+    def message(self, data):
+        """Internal use only: not a public interface"""
+        # data is the hex of one message, split in ISO-TP frames when it does
+        # not fit in a single CAN frame
+        count = len(data) / 2
+        header = ""
+        if self.headers:
+            header = SIMULATED_HEADER
+            if self.spaces:
+                header += " "
+
+        if count <= 7:
+            if self.headers:
+                return [header + self.format_bytes("%02X" % count + data)]
+            return [self.format_bytes(data)]
+
+        frames = [data[:12]]
+        data = data[12:]
+        while data:
+            frames.append(data[:14])
+            data = data[14:]
+        frames[-1] += "00" * ((14 - len(frames[-1])) / 2)
+
+        if self.headers:
+            # raw frames with their protocol control byte
+            lines = [header + self.format_bytes("1%03X" % count + frames[0])]
+            for i, frame in enumerate(frames[1:]):
+                lines.append(header + self.format_bytes("2%X" % ((i + 1) % 16) + frame))
+            return lines
+
+        lines = ["%03X" % count]
+        for i, frame in enumerate(frames):
+            line = "%X:" % (i % 16)
+            if self.spaces:
+                line += " "
+            lines.append(line + self.format_bytes(frame))
+        return lines
+
+    def broadcast(self):
+        """Internal use only: not a public interface"""
+        now = time.time()
+        if now - self.monitor_next > 1:
+            # the reader fell behind, the ELM buffer would have overflowed
+            self.monitor_next = now
+        eol = "\r"
+        if self.linefeeds:
+            eol = "\r\n"
+        while self.monitor_next <= now:
+            can_id, data = SIMULATED_BROADCASTS[self.monitor_frame]
+            self.monitor_frame = (self.monitor_frame + 1) % len(SIMULATED_BROADCASTS)
+            self.monitor_next += SIMULATED_BROADCAST_INTERVAL
+            if self.can_mask is not None and \
+                    int(can_id, 16) & self.can_mask != self.can_filter & self.can_mask:
+                continue
+            line = self.format_bytes(data)
+            if self.headers:
+                if self.spaces:
+                    line = " " + line
+                line = can_id + line
+            self.output += line + eol
+
+    def reply(self, command):
+        """Internal use only: not a public interface"""
+        if command.startswith("AT"):
+            return self.reply_at(command[2:])
+
+        if command[:2] == "01" and len(command) > 2:
+            pids = command[2:]
+            if len(pids) % 2:
+                # trailing response count
+                pids = pids[:-1]
+            pids = [int(pids[i:i+2], 16) for i in range(0, len(pids), 2)]
+            if len(pids) > 1 and not self.multi_pid:
+                return ["?"]
+            data = ""
+            for pid in pids:
+                if pid % 0x20 == 0:
+                    data += "%02X" % pid + supported_pids_mask(self.values, pid)
+                elif pid in self.values:
+                    data += "%02X" % pid + self.values[pid]
+            if data == "":
+                return ["NO DATA"]
+            return self.message("41" + data)
+
+        if command[:2] == "09" and command[2:] in self.info:
+            text, size = self.info[command[2:]]
+            if text is None:
+                return ["NO DATA"]
+            return self.message("49" + command[2:] + "01" + hexlify(text.ljust(size, "\x00")).upper())
+
+        if command in ("03", "07"):
+            codes = self.dtc
+            if command == "07":
+                codes = self.pending_dtc
+            mode = "%02X" % (int(command) + 0x40)
+            return self.message(mode + "%02X" % len(codes) + "".join(codes))
+
+        if command == "04":
+            self.dtc = []
+            self.pending_dtc = []
+            return ["44"]
+
+        return ["?"]
+
+    def reply_at(self, command):
+        """Internal use only: not a public interface"""
+        if command in ("Z", "WS"):
+            self.reset()
+            return ["", "ELM327 v1.5"]
+        if command == "I":
+            return ["ELM327 v1.5"]
+        if command == "DPN":
+            return ["A6"]
+        if command == "D":
+            self.reset()
+            return ["OK"]
+        if command[:2] == "CF":
+            self.can_filter = int(command[2:], 16)
+            return ["OK"]
+        if command[:2] == "CM":
+            self.can_mask = int(command[2:], 16)
+            if self.can_filter is None:
+                self.can_filter = 0
+            return ["OK"]
+        if command[:1] in ("E", "S", "L", "H") and command[1:] in ("0", "1"):
+            setting = command[1:] == "1"
+            if command[0] == "E":
+                self.echo = setting
+            elif command[0] == "S":
+                self.spaces = setting
+            elif command[0] == "L":
+                self.linefeeds = setting
+            else:
+                self.headers = setting
+        return ["OK"]
+
+
+class CarberryRecordingTransport:
+    """ CarberryRecordingTransport wraps a serial port and records every
+    command with its reply and latency, for CarberryReplayTransport."""
+
+    def __init__(self, port):
+        self.port = port
+        self.name = port.name
+        self.portstr = port.portstr
+        self.timeout = port.timeout
+
+        # [command, reply, latency] of each exchange
+        self.session = []
+        self.command = ""
+        self.reply = ""
+        self.sent_at = 0
+
+    def write(self, data):
+        self.port.write(data)
+        for c in data:
+            if c == "\r":
+                self.session.append([self.command, "", 0])
+                self.sent_at = time.time()
+                self.command = ""
+            elif c != "\n":
+                self.command += c
+
+    def inWaiting(self):
+        return self.port.inWaiting()
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        if self.session:
+            exchange = self.session[-1]
+            exchange[1] += data
+            if ">" in data:
+                exchange[2] = time.time() - self.sent_at
+        return data
+
+    def flushInput(self):
+        self.port.flushInput()
+
+    def flushOutput(self):
+        self.port.flushOutput()
+
+    def close(self):
+        self.port.close()
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.session, f)
+
+
+class CarberryReplayTransport:
+    """ CarberryReplayTransport answers commands with the replies of a session
+    recorded by CarberryRecordingTransport. The replies to a command are
+    played back in order and start over once exhausted."""
+
+    def __init__(self, filename, speed=1.0):
+        self.name = filename
+        self.portstr = filename
+        self.timeout = 2
+        # latency is divided by speed, 0 replays as fast as possible
+        self.speed = speed
+
+        with open(filename) as f:
+            session = json.load(f)
+
+        # command -> [next position, [(reply, latency)...]]
+        self.replies = {}
+        for command, reply, latency in session:
+            key = command.strip().upper()
+            if key not in self.replies:
+                self.replies[key] = [0, []]
+            self.replies[key][1].append((str(reply), latency))
+
+        self.command = ""
+        self.output = ""
+        self.ready_at = 0
+
+    def write(self, data):
+        for c in data:
+            if c == "\r":
+                self.answer(self.command.strip().upper())
+                self.command = ""
+            elif c != "\n":
+                self.command += c
+
+    def answer(self, command):
+        """Internal use only: not a public interface"""
+        if command not in self.replies:
+            self.output = "?\r\r>"
+            self.ready_at = time.time()
+            return
+
+        entry = self.replies[command]
+        reply, latency = entry[1][entry[0]]
+        entry[0] = (entry[0] + 1) % len(entry[1])
+        self.output = reply
+        if self.speed:
+            self.ready_at = time.time() + latency / self.speed
+        else:
+            self.ready_at = time.time()
+
+    def inWaiting(self):
+        if time.time() < self.ready_at:
+            return 0
+        return len(self.output)
+
+    def read(self, size=1):
+        if self.output and time.time() < self.ready_at:
+            time.sleep(min(self.ready_at - time.time(), self.timeout))
+            if time.time() < self.ready_at:
+                return ""
+        data = self.output[:size]
+        self.output = self.output[size:]
+        return data
+
+    def flushInput(self):
+        self.output = ""
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
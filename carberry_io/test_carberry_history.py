@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+import unittest
+from carberry_history import CarberrySensorHistory
+
+
+class CarberrySensorHistoryTest(unittest.TestCase):
+
+    def test_ring_overflow(self):
+        # 40 Hz: the ring wraps long before the window elapses
+        history = CarberrySensorHistory(capacity=600, window=60.0)
+        for i in range(3000):
+            history.add(i * 0.025, float(i))
+
+        self.assertEqual(len(history), 600)
+        self.assertEqual(history.mean(), 2699.5)
+        self.assertEqual(history.min(), 2400.0)
+        self.assertEqual(history.max(), 2999.0)
+        self.assertAlmostEqual(history.rate(), 40.0)
+
+    def test_window(self):
+        history = CarberrySensorHistory(capacity=600, window=10.0)
+        for i in range(100):
+            history.add(float(i), float(i % 7))
+
+        values = [float(i % 7) for i in range(90, 100)]
+        self.assertEqual(len(history), 11)
+        self.assertEqual(history.mean(), sum(values + [89 % 7]) / 11)
+        self.assertEqual(history.min(), 0.0)
+        self.assertEqual(history.max(), 6.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,35 +1,50 @@
-import serial
+__author__ = 'axes'
+import glob
+import json
+import os
+
+# Where connection details are kept between runs
+CACHE_DIR = os.path.expanduser("~/.carberry")
+LAST_PORT_FILE = os.path.join(CACHE_DIR, "last_port.json")
+
+# Serial device patterns, in the order they are tried
+SERIAL_PATTERNS = [
+    "/dev/rfcomm*",  # Bluetooth connection
+    "/dev/ttyUSB*",  # On raspbian it seems to be /dev/ttyUSB<N>
+    "/dev/ttyS*",    # On standard debian / ubuntu, the serial connection is /dev/ttyS<N>
+    ]
 
 
 def scan_serial():
     """Scans for available ports. returns a list of serial names"""
     available_ports = []
 
-    # Find available Bluetooth connection
-    for i in range(256):
-        try:
-            s = serial.Serial("/dev/rfcomm"+str(i))
-            available_ports.append((str(s.port)))
-            s.close()   # explicit close 'cause of delayed GC in java
-        except serial.SerialException:
-            pass
-
-    # On standard debian / ubuntu, the serial connection is /dev/ttyS<N> where 0 < N < 255
-    for i in range(256):
-        try:
-            s = serial.Serial("/dev/ttyS"+str(i))
-            available_ports.append(s.portstr)
-            s.close()   # explicit close 'cause of delayed GC in java
-        except serial.SerialException:
-            pass
-
-    # On raspbian it seems to be /dev/ttyUSB<N> instead
-    for i in range(256):
-        try:
-            s = serial.Serial("/dev/ttyUSB"+str(i))
-            available_ports.append(s.portstr)
-            s.close()   # explicit close 'cause of delayed GC in java
-        except serial.SerialException:
-            pass
-    
+    # Only list device nodes that exist, opening them is left to the caller
+    for pattern in SERIAL_PATTERNS:
+        names = glob.glob(pattern)
+        # /dev/ttyS2 before /dev/ttyS10
+        names.sort(key=lambda name: (len(name), name))
+        available_ports.extend(names)
+
     return available_ports
+
+
+def load_last_port():
+    """Returns (port name, baud rate) of the last port that worked, or None"""
+    try:
+        with open(LAST_PORT_FILE) as f:
+            last = json.load(f)
+        return last["port"], last["baud"]
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def save_last_port(port, baud):
+    """Remembers the port that worked, so it is tried first next time"""
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        with open(LAST_PORT_FILE, "w") as f:
+            json.dump({"port": port, "baud": baud}, f)
+    except (IOError, OSError) as e:
+        print e
@@ -1,24 +1,35 @@
 #!/usr/bin/env python
 
-try:
-    import wx
-    
-    EVT_DEBUG_ID = 1010
-    
-    def debug_display(window, position, message):
-        if window is None:
-            print message
-        else:
-            wx.PostEvent(window, DebugEvent([position, message]))
-       
-    class DebugEvent(wx.PyEvent):
-        """Simple event to carry arbitrary result data."""
-        def __init__(self, data):
-            """Init Result Event."""
-            wx.PyEvent.__init__(self)
-            self.SetEventType(EVT_DEBUG_ID)
-            self.data = data
-
-except ImportError as e:
-    def debug_display(window, position, message):
-        print message
\ No newline at end of file
+# wx is only imported when a window is given, so that headless users of the
+# ports do not pay for it
+
+EVT_DEBUG_ID = 1010
+
+# DebugEvent class, created on first use
+debug_event_class = None
+
+
+def DebugEvent(data):
+    """Simple event to carry arbitrary result data."""
+    global debug_event_class
+    if debug_event_class is None:
+        import wx
+
+        class DebugEvent(wx.PyEvent):
+            """Simple event to carry arbitrary result data."""
+            def __init__(self, data):
+                """Init Result Event."""
+                wx.PyEvent.__init__(self)
+                self.SetEventType(EVT_DEBUG_ID)
+                self.data = data
+
+        debug_event_class = DebugEvent
+    return debug_event_class(data)
+
+
+def debug_display(window, position, message):
+    if window is None:
+        print message
+    else:
+        import wx
+        wx.PostEvent(window, DebugEvent([position, message]))